@@ -7,22 +7,101 @@
 # directory.
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
 import dataclasses
 import functools
+import hashlib
 import io
+import itertools
+import json
 import os.path
 import pathlib
 import re
+import sqlite3
 import textwrap
-from typing import Union, Optional, Literal, Tuple, Dict, Any, Type, List
+import threading
+import time
+from typing import Union, Optional, Literal, Tuple, Dict, Any, Type, List, Callable, Sequence
 
 import numpy as numpy
 import pytest
-from PIL import Image, ImageCms, ImageOps, ImageFilter, UnidentifiedImageError
+from PIL import Image, ImageCms, ImageDraw, ImageOps, ImageFilter, UnidentifiedImageError
 
 DEFAULT_OUTDIR = pathlib.Path("training_images")
 DEFAULT_SIZE = 512
 DEFAULT_QUALITY = 1 / 2.0
+DEFAULT_WRITE_BUFFER = 256 * 2**20
+
+
+class StageTimer:
+    """
+    Time spent, calls made and pixels and bytes handled by each stage of processing:
+    "decode", "cmyk" (conversion), "color" (check), "hash" (fuzzy hash, including
+    compositing the mask), "render" (masking and scaling to the output square),
+    "encode" and "write". Stages may be timed from several threads at once, and the
+    totals from `--jobs` workers are merged in, so the seconds for a stage are summed
+    over everything that did that work rather than being wall time.
+    """
+    columns = ('calls', 'seconds', 'pixels', 'bytes')
+
+    def __init__(self):
+        self.stages = {}
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name: str, pixels: int = 0, nbytes: int = 0):
+        """
+        Time the body of a `with` as the named stage. The counts are yielded as a dict,
+        so that bytes only known at the end (such as encoded sizes) can be filled in.
+        """
+        counts = {'pixels': pixels, 'bytes': nbytes}
+        start = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            self.add(name, dict(counts, calls=1, seconds=time.perf_counter() - start))
+
+    def add(self, name: str, counts: Dict[str, Union[int, float]]):
+        """Add counts (any of `columns`) to a stage"""
+        with self.lock:
+            totals = self.stages.setdefault(name, dict.fromkeys(self.columns, 0))
+            for column in self.columns:
+                totals[column] += counts.get(column, 0)
+
+    def merge(self, stages: Dict[str, Dict[str, Union[int, float]]]):
+        """Add in the `stages` of another StageTimer, such as one from a worker process"""
+        for name, counts in stages.items():
+            self.add(name, counts)
+
+    def as_dict(self):
+        """The totals so far, along with the wall time since this timer was made"""
+        with self.lock:
+            return {
+                'wall_seconds': time.perf_counter() - self.started,
+                'stages': {name: dict(totals) for name, totals in self.stages.items()},
+            }
+
+    def summarize(self):
+        """Print a table of the time and throughput of each stage"""
+        totals = self.as_dict()
+        print(f"{'stage':<8} {'calls':>7} {'seconds':>9} {'Mpixels':>9} {'MB':>9} {'Mpixels/s':>10} {'MB/s':>9}")
+        for name, stage in sorted(totals['stages'].items(), key=lambda item: -item[1]['seconds']):
+            seconds = stage['seconds'] or float('inf')
+            print(
+                f"{name:<8} {stage['calls']:>7} {stage['seconds']:>9.3f} {stage['pixels'] / 1e6:>9.2f}"
+                f" {stage['bytes'] / 2**20:>9.2f} {stage['pixels'] / 1e6 / seconds:>10.2f}"
+                f" {stage['bytes'] / 2**20 / seconds:>9.2f}")
+        print(f"Wall time: {totals['wall_seconds']:.3f}s")
+
+
+def timed(timer: Optional[StageTimer], name: str, pixels: int = 0, nbytes: int = 0):
+    """`timer.stage(...)`, or a context that does nothing if there is no timer"""
+    if timer is None:
+        return contextlib.nullcontext({})
+    return timer.stage(name, pixels=pixels, nbytes=nbytes)
 
 
 @dataclasses.dataclass
@@ -30,13 +109,39 @@ class ImageInfo:
     """
     A wrapper class for a PIL Image that tracks things we wish to know
     about it, and provides some helper methods
+
+    Values derived from the pixels (the color check, fuzzy hash and scaled
+    thumbnails) are computed at most once and kept in `cache` until the image
+    is replaced. The small ones survive `release`, which drops the pixel data.
+
+    `size` is always the size of the source image, even when `draft` has
+    arranged for the pixels to be decoded at a reduced scale.
+
+    An ImageInfo made by `masked` stands for its image composited through a mask
+    onto `background`, but the composite is never built at full size: the fuzzy
+    hash only needs one of `composite_size`.
+
+    If it has a `timer`, decoding and the work cached here are timed on it.
     """
     file_path: os.PathLike
-    image: Image
+    image: Optional[Image]
     is_mask: bool = False
+    mask: Optional["ImageInfo"] = None
+    background: Optional[tuple] = None
+    size: Tuple[int, int] = dataclasses.field(init=False)
+    cache: Dict[Any, Any] = dataclasses.field(init=False, default_factory=dict, repr=False)
+    timer: Optional[StageTimer] = dataclasses.field(default=None, repr=False)
+
+    sample_pixels = 64 * 1024
+    # Room for the fuzzy hash to crop away a white border and still have
+    # FuzzyImageRecall.hash_size pixels left to work with
+    composite_size = 512
+
+    def __post_init__(self):
+        self.size = self.image.size
 
     @classmethod
-    def get_image_info(cls, img_path: os.PathLike):
+    def get_image_info(cls, img_path: os.PathLike, timer: Optional[StageTimer] = None):
         """Read info about an image"""
 
         img_obj = Image.open(os.fspath(img_path))
@@ -44,15 +149,118 @@ class ImageInfo:
         return cls(
             file_path=img_path,
             image=img_obj,
+            timer=timer,
         )
 
     @property
     def width(self):
-        return self.image.width
+        return self.size[0]
 
     @property
     def height(self):
-        return self.image.height
+        return self.size[1]
+
+    def _cached(self, name, compute, stage: Optional[str] = None, decode: bool = True):
+        if name not in self.cache:
+            assert self.image is not None, f"Image data for {self.file_path} was already released"
+            if decode:
+                self.load()
+            with timed(self.timer if stage else None, stage):
+                self.cache[name] = compute()
+        return self.cache[name]
+
+    @property
+    def decoded(self):
+        """Are the pixels in memory (decoded, or made there), rather than still in the file?"""
+        return self.image is not None and not getattr(self.image, 'tile', None)
+
+    def load(self):
+        """Decode the pixels (and the mask's) now, if that hasn't happened yet"""
+        # A lazily opened image has tiles left to decode until it is loaded
+        if self.image is not None and getattr(self.image, 'tile', None):
+            nbytes = os.path.getsize(self.file_path) if self.timer else 0
+            with timed(self.timer, 'decode', pixels=self.image.width * self.image.height, nbytes=nbytes):
+                self.image.load()
+        if self.mask is not None:
+            self.mask.load()
+
+    def _set_image(self, image: Image):
+        self.image = image
+        self.cache.clear()
+
+    def draft(self, size: int):
+        """
+        Ask the decoder to produce no more than is needed to scale the image to fit
+        a `size` square (JPEG can decode at 1/2, 1/4 or 1/8 scale), but never less
+        than the fuzzy hash is taken at (see `FuzzyImageRecall.hash_size`). This only
+        works before anything has decoded the pixels, and never for images that must
+        match a mask pixel for pixel. Returns True if the image will be decoded reduced.
+        """
+        size = max(size, FuzzyImageRecall.hash_size)
+        if self.image is None or self.image.draft(None, (size, size)) is None:
+            return False
+        self.cache.clear()
+        return self.image.size != self.size
+
+    @property
+    def color(self):
+        """The cached result of `is_color` for this image"""
+        # is_color answers for L and 1 mode images without looking at the pixels
+        decode = self.image is not None and self.image.mode[0] not in ('L', '1')
+        return self._cached('color', lambda: self.is_color(self.image), stage='color', decode=decode)
+
+    def masked(self, mask: "ImageInfo", background: tuple):
+        """Return an ImageInfo for this image composited through `mask` onto `background`"""
+        return type(self)(
+            file_path=self.file_path, image=self.image, mask=mask, background=background, timer=self.timer)
+
+    @staticmethod
+    def hash_scale(size: Tuple[int, int]):
+        """The reduction (1, 2, 4 or 8) that a JPEG of this size decodes at to `draft` for the hash alone"""
+        scale = min(size) // FuzzyImageRecall.hash_size
+        return next((reduction for reduction in (8, 4, 2) if scale >= reduction), 1)
+
+    def composite(self):
+        """
+        The image to hash: itself, reduced to the scale of `hash_scale`, or if masked, a
+        composite scaled to fit `composite_size`. However far it was drafted, an image is
+        then hashed from the same grid of pixels that a full decode would give it.
+        """
+        if self.mask is None:
+            # A draft never reduces by more than this, so this is what remains to do
+            reduction = self.hash_scale(self.size) // max(1, round(self.width / self.image.width))
+            if reduction > 1 and self.image.mode in ('L', 'RGB', 'CMYK'):
+                return self.image.reduce(reduction)
+            return self.image
+        image, mask = self.image, self.mask.image
+        if max(self.image.size) > self.composite_size:
+            size = (self.composite_size, self.composite_size)
+            image, mask = ImageOps.contain(image, size=size), ImageOps.contain(mask, size=size)
+        return mask_image(image, mask, background=self.background)
+
+    def fuzzy_key(self, history: "FuzzyImageRecall", sources: Optional[List[os.PathLike]] = None):
+        """
+        The cached fuzzy hash (see `FuzzyImageRecall.image_key`) of this image. Nothing
+        is decoded if `history` already knows the hash of unchanged `sources`.
+        """
+        if 'key' not in self.cache:
+            key = history.cached_key(sources)
+            if key is None:
+                key = self._cached('key', lambda: history.image_key(self.composite), stage='hash')
+                history.remember_key(sources, key)
+            self.cache['key'] = key
+        return self.cache['key']
+
+    def thumbnail(self, size: int):
+        """The cached image scaled to fit within a `size` square"""
+        return self._cached(('thumbnail', size), lambda: ImageOps.contain(self.image, size=(size, size)))
+
+    def release(self):
+        """Drop the pixel data and thumbnails, keeping the size, color check and hash"""
+        # Not closed, a queued write (see ImageWriter) may still be using the same image
+        self.image = None
+        for name in [name for name in self.cache if isinstance(name, tuple)]:
+            del self.cache[name]
 
     @classmethod
     def is_color(cls, image: Image):
@@ -65,22 +273,34 @@ class ImageInfo:
         that have transparency. That's not a problem I feel we need to
         solve here.
 
+        The pixels are checked in stages: a strided sample of about `sample_pixels`
+        pixels finds the color in most color images, and only when that comes up
+        gray is every pixel checked (one stray color pixel is enough).
+
         This is a class method so that it can be used in places where we don't have
-        an ImageInfo object handy.
+        an ImageInfo object handy. The `color` property caches the answer.
         """
-        if image.mode[0] in ('L', '1'):
+        if image.mode[0] in ('L', '1', 'I', 'F'):
             return False
 
-        if image.mode != 'RGB':
+        step = int((image.width * image.height / cls.sample_pixels) ** 0.5)
+        if step > 1:
+            sample_size = (max(1, image.width // step), max(1, image.height // step))
+            # Nearest neighbor scaling picks out actual pixels, in whatever mode
+            if cls._has_color_pixels(image.resize(sample_size, Image.NEAREST)):
+                return True
+        return cls._has_color_pixels(image)
+
+    @staticmethod
+    def _has_color_pixels(image: Image):
+        """Does any pixel differ between its red, green and blue channels?"""
+        if image.mode not in ('RGB', 'RGBA', 'RGBX'):
             # This is pretty heavy-weight, but any other solution requires lots of special cases
             # around each potential permutation of image.mode. Just try to get this right
             # for RGBa and PA at the same time, I dare you...
             image = image.convert('RGB')
-
-        for count, color in image.getcolors(maxcolors=257):
-            if len(set(color)) > 1:
-                return True
-        return False
+        pixels = numpy.asarray(image)
+        return bool((pixels[..., 0] != pixels[..., 1]).any() or (pixels[..., 1] != pixels[..., 2]).any())
 
     def masked_by(self, other: "ImageInfo"):
         """
@@ -97,13 +317,13 @@ class ImageInfo:
         return(
             self.height == other.height and
             self.width == other.width and
-            self.is_color(self.image) and not other.is_color(other.image)
+            self.color and not other.color
         )
 
     def to_rgb(self):
         """Turn this image into RGB mode, without any image profile assistance"""
         assert not self.is_mask, f"Cannot convert a mask ({self.file_path}) to RGB!"
-        self.image = self.image.convert('RGB')
+        self._set_image(self.image.convert('RGB'))
 
     def from_cmyk_to_rgb(
             self,
@@ -118,32 +338,52 @@ class ImageInfo:
         :return: NA
         """
 
-        if not srgb_profile:
-            # Use the built in default sRGB color space
-            srgb_profile = ImageCms.createProfile('sRGB')
-
-        # Check to see if the image has an embedded profile
-        img_profile_data = self.image.info.get('icc_profile')
-        if img_profile_data:
-            image_profile = ImageCms.ImageCmsProfile(io.BytesIO(img_profile_data))
-        else:
-            image_profile = cmyk_profile
-
-        tmp_img = ImageCms.profileToProfile(
-            self.image,
-            inputProfile=image_profile,
-            outputProfile=srgb_profile,
-            renderingIntent=0,
-            outputMode='RGB'
-        )
+        # Use the image's embedded profile, if it has one
+        transform = cmyk_transform(self.image.mode, self.image.info.get('icc_profile'), cmyk_profile, srgb_profile)
+        self.load()
+        with timed(self.timer, 'cmyk', pixels=self.image.width * self.image.height):
+            tmp_img = ImageCms.applyTransform(self.image, transform)
         if tmp_img:
-            self.image = tmp_img
+            self._set_image(tmp_img)
         else:
             print("  WARNING: Cannot convert color profile in TIFF image")
             print("  WARNING: ... will try naive conversion")
             self.to_rgb()
 
 
+class HammingIndex:
+    """
+    A multi-index hash of fixed-length keys, used to find stored keys that differ from
+    a query in at most `threshold` positions without comparing against all of them.
+
+    Keys are split into `threshold + 1` blocks. By the pigeonhole principle, a key within
+    the threshold must match the query exactly on at least one block, so only keys that
+    share a block with the query are candidates for the full comparison.
+    """
+    def __init__(self, threshold: int, length: int = 100):
+        assert 0 < threshold < length, "Threshold must be positive and less than the key length"
+        self.threshold = threshold
+        bounds = [length * n // (threshold + 1) for n in range(threshold + 2)]
+        self.blocks = list(zip(bounds[:-1], bounds[1:]))
+        self.tables = [{} for _ in self.blocks]
+
+    def add(self, key: Tuple[int, ...]):
+        """Add a key to the index"""
+        for (start, end), table in zip(self.blocks, self.tables):
+            table.setdefault(key[start:end], []).append(key)
+
+    def near(self, key: Tuple[int, ...]):
+        """Generate every stored key that differs from `key` in at most `threshold` positions"""
+        found = set()
+        for (start, end), table in zip(self.blocks, self.tables):
+            for candidate in table.get(key[start:end], ()):
+                if candidate in found:
+                    continue
+                found.add(candidate)
+                if sum(1 for a, b in zip(key, candidate) if a != b) <= self.threshold:
+                    yield candidate
+
+
 class FuzzyImageRecall:
     """
     A tracking class used to keep a record of the images we've seen with
@@ -158,64 +398,183 @@ class FuzzyImageRecall:
     This is a trivial matching function that can be easily "defeated" but we
     don't really care. All we want is to identify simple duplication and some
     very trivial transformations.
+
+    If `index_path` is given, the hashes are also kept in a SQLite file so that
+    later runs start out knowing about everything seen before. Each hash records
+    its owner (the output file it was produced for) so that re-running over the
+    same images does not find them to be duplicates of themselves, and the hash
+    of each set of source files is remembered by path, size and mtime so that
+    unchanged sources need not be hashed again.
+
+    A non-zero `threshold` also counts images as duplicates when up to that many of
+    the 100 cells differ, which is looked up through a `HammingIndex`.
+
+    The 100-tuples depend on exactly how they are made, so an index made with a
+    different `key_version` is emptied rather than compared against.
+
+    When images are made at several output sizes, `unclaimed` and `claim` decide
+    duplicates per size, so that an image too small for the largest sizes only
+    counts against later images at the sizes it was made at.
     """
-    def __init__(self):
-        self.seen = set()
+    commit_interval = 1000
+    hash_size = 128
+    key_version = 2
+
+    def __init__(self, index_path: Optional[os.PathLike] = None, threshold: int = 0):
+        self.seen = {}
+        self.threshold = threshold
+        self.near = HammingIndex(threshold) if threshold else None
+        self.partial = {}
+        self.claims = None
+        self.index = None
+        self._uncommitted = 0
+        if index_path is not None:
+            self.index = sqlite3.connect(os.fspath(index_path))
+            self.index.execute("CREATE TABLE IF NOT EXISTS seen (hash TEXT PRIMARY KEY, owner TEXT)")
+            self.index.execute("CREATE TABLE IF NOT EXISTS files (signature TEXT PRIMARY KEY, hash TEXT)")
+            if self.index.execute("PRAGMA user_version").fetchone()[0] != self.key_version:
+                self.index.execute("DELETE FROM seen")
+                self.index.execute("DELETE FROM files")
+                self.index.execute(f"PRAGMA user_version = {self.key_version:d}")
+                self.index.commit()
+            for hash_str, owner in self.index.execute("SELECT hash, owner FROM seen"):
+                self._track(self.parse_repr(hash_str), owner)
 
     def __contains__(self, image: Image):
         """Allow the `in` operator to work on this class to test membership of an image"""
-        return self._to_tuple(image) in self.seen
+        return self.contains_key(self._to_tuple(image))
+
+    def contains_key(self, key: Tuple[int, ...], owner: Optional[str] = None):
+        """
+        Test membership of an already computed 100-tuple (see `_to_tuple`). A
+        hash that was recorded for `owner` itself does not count.
+        """
+        if self.near is None:
+            return key in self.seen and (owner is None or self.seen[key] != owner)
+        return any(owner is None or self.seen[match] != owner for match in self.near.near(key))
+
+    def unclaimed(self, key: Tuple[int, ...], outputs: List[Tuple[int, pathlib.Path]]):
+        """
+        Those of `outputs` (size and path, largest first, see `sized_outputs`) that an
+        image with this 100-tuple is not a duplicate at. A hash recorded for the first
+        path, or at a given size for that size's path, does not count.
+        """
+        if self.contains_key(key, owner=str(outputs[0][1])):
+            return []
+        return [
+            (size, path) for size, path in outputs
+            if size not in self.partial or not self.partial[size].contains_key(key, owner=str(path))
+        ]
+
+    def claim(self, key: Tuple[int, ...], outputs: List[Tuple[int, pathlib.Path]], full: bool = True):
+        """
+        Record this 100-tuple for `outputs` (see `unclaimed`). A `full` claim, by an
+        image that is made at every output size, is owned by the first path as with
+        `add_key`. Otherwise it only makes later images duplicates at the sizes in
+        `outputs`, and is not kept in the persistent index. Claims are also listed as
+        (hash, outputs, full) in `claims`, if that is a list, even when the hash was
+        already recorded for the same owner.
+        """
+        if self.claims is not None:
+            self.claims.append((key, outputs, full))
+        if full:
+            self.add_key(key, owner=str(outputs[0][1]))
+            return
+        for size, path in outputs:
+            if size not in self.partial:
+                self.partial[size] = FuzzyImageRecall(threshold=self.threshold)
+            self.partial[size].add_key(key, owner=str(path))
 
     def _to_tuple(self, image: Image, blur_radius: int = 3):
         """Convert an image into a 100-tuple by scaling to 10x10 and grayscaling"""
         # Note that we don't respect aspect ratio. This is by design and allows us to
-        # detect some stretching between copies.
-        blurred_10x10 = self._autocrop(image).convert("L").filter(
+        # detect some stretching between copies. Scaling to `hash_size` first means the
+        # blur is the same however large the image was (see `ImageInfo.composite`).
+        normalized = self._autocrop(image).convert("L").resize((self.hash_size, self.hash_size), Image.LANCZOS)
+        blurred_10x10 = normalized.filter(
             ImageFilter.GaussianBlur(radius=blur_radius)).resize((10, 10), Image.LANCZOS)
         simplified = blurred_10x10.quantize(colors=16)
         return tuple(simplified.getdata())
 
     def hash_repr(self, image: Image, *args):
         """Produce a string version of the hash"""
-        tuple_rep = self._to_tuple(image, *args)
+        return self.key_repr(self._to_tuple(image, *args))
+
+    @staticmethod
+    def key_repr(tuple_rep: Tuple[int, ...]):
+        """Produce a string version of an already computed 100-tuple"""
         return "".join(f"{(tuple_rep[p] << 4) + tuple_rep[p+1]:02X}" for p in range(0, len(tuple_rep), 2))
 
+    @staticmethod
+    def parse_repr(hash_str: str):
+        """The inverse of `key_repr`"""
+        return tuple(nibble for byte in bytes.fromhex(hash_str) for nibble in (byte >> 4, byte & 0xF))
+
+    @staticmethod
+    def _signature(sources: List[os.PathLike]):
+        """Identify a set of source files by path, size and modification time"""
+        parts = []
+        for source in sources:
+            stat = os.stat(source)
+            parts.append(f"{os.path.abspath(source)}:{stat.st_size}:{stat.st_mtime_ns}")
+        return "\n".join(parts)
+
+    def cached_key(self, sources: List[os.PathLike]):
+        """Return the 100-tuple previously computed from these unchanged source files, if any"""
+        if self.index is None or not sources:
+            return None
+        row = self.index.execute(
+            "SELECT hash FROM files WHERE signature = ?", (self._signature(sources),)).fetchone()
+        return self.parse_repr(row[0]) if row else None
+
+    def remember_key(self, sources: List[os.PathLike], key: Tuple[int, ...]):
+        """Record the 100-tuple computed from these source files (see `cached_key`)"""
+        if self.index is None or not sources:
+            return
+        self.index.execute(
+            "INSERT OR REPLACE INTO files (signature, hash) VALUES (?, ?)",
+            (self._signature(sources), self.key_repr(key)))
+        self._changed()
+
+    def image_key(self, image: Union[Image, Callable[[], Image]], sources: Optional[List[os.PathLike]] = None):
+        """
+        Return the 100-tuple for an image, reusing the persisted hash for unchanged sources.
+        The image may be given as a function that builds it, so that it is only built when
+        the hash is not already known.
+        """
+        key = self.cached_key(sources)
+        if key is None:
+            key = self._to_tuple(image() if callable(image) else image)
+            self.remember_key(sources, key)
+        return key
+
     @staticmethod
     def _autocrop(image: Image):
         """Find the largest sub-image that does not have an all-white border on any side"""
-        upper_left_x = 0
-        upper_left_y = 0
-        lower_right_x = image.width - 1
-        lower_right_y = image.height - 1
         white = white_pixel(image.mode)
         np_image = numpy.asarray(image)
-
-        def first_column(from_end=False):
-            cols = range(upper_left_x, lower_right_x)
-            if from_end:
-                cols = reversed(cols)
-            for x in cols:
-                if numpy.any(np_image[:, x] != white):
-                    return x
-            return None
-
-        def first_row(from_end=False):
-            rows = range(upper_left_y, lower_right_y)
-            if from_end:
-                rows = reversed(rows)
-            for y in rows:
-                if numpy.any(np_image[y, :] != white):
-                    return y
-            return None
-
-        upper_left_x = first_column()
-        if upper_left_x is None:
+        if np_image.ndim > 2:
+            # Compare whole rows of channel values at once, a broadcast against a
+            # short pixel tuple is many times slower
+            height, width, channels = np_image.shape
+            white_row = numpy.tile(numpy.asarray(white, dtype=np_image.dtype), width)
+            non_white = np_image.reshape(height, width * channels) != white_row
+            columns = non_white.any(axis=0).reshape(width, channels).any(axis=1)
+        else:
+            non_white = np_image != white
+            columns = non_white.any(axis=0)
+        # The last column and row are never searched for a boundary, just as in the
+        # original column-by-column scan that this replaced.
+        columns = columns[:-1]
+        if not columns.any():
             return image
-        lower_right_x = first_column(from_end=True)
-        upper_left_y = first_row()
-        if upper_left_y is None:
+        rows = non_white[:-1].any(axis=1)
+        if not rows.any():
             return image
-        lower_right_y = first_row(from_end=True)
+        upper_left_x = int(columns.argmax())
+        lower_right_x = len(columns) - 1 - int(columns[::-1].argmax())
+        upper_left_y = int(rows.argmax())
+        lower_right_y = len(rows) - 1 - int(rows[::-1].argmax())
 
         rect = (upper_left_x, upper_left_y, lower_right_x+1, lower_right_y+1)
         try:
@@ -225,7 +584,65 @@ class FuzzyImageRecall:
 
     def add(self, image: Image):
         """Add the given image to our tracking"""
-        self.seen.add(self._to_tuple(image))
+        self.add_key(self._to_tuple(image))
+
+    def add_key(self, key: Tuple[int, ...], owner: Optional[str] = None):
+        """Add an already computed 100-tuple (see `_to_tuple`) to our tracking"""
+        if key in self.seen:
+            return
+        self._track(key, owner)
+        if self.index is not None:
+            self.index.execute(
+                "INSERT OR IGNORE INTO seen (hash, owner) VALUES (?, ?)", (self.key_repr(key), owner))
+            self._changed()
+
+    def _track(self, key: Tuple[int, ...], owner: Optional[str]):
+        self.seen[key] = owner
+        if self.near is not None:
+            self.near.add(key)
+
+    def _changed(self):
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_interval:
+            self.flush()
+
+    def flush(self):
+        """Write any pending changes to the persistent index"""
+        if self.index is not None and self._uncommitted:
+            self.index.commit()
+            self._uncommitted = 0
+
+    def close(self):
+        """Flush and close the persistent index"""
+        if self.index is not None:
+            self.flush()
+            self.index.close()
+            self.index = None
+
+
+@functools.cache
+def cmyk_transform(
+        mode: str,
+        embedded_profile: Optional[bytes],
+        cmyk_profile: Optional[Union[ImageCms.ImageCmsProfile, os.PathLike]] = None,
+        srgb_profile: Optional[Union[ImageCms.ImageCmsProfile, os.PathLike]] = None,
+):
+    """
+    Return a transform from the color profile of an image in `mode` to sRGB. The
+    profile is the one embedded in the image if there is one, otherwise `cmyk_profile`.
+
+    Building a transform means parsing both profiles, and a whole book usually shares
+    one embedded profile, so transforms are cached by the profile bytes (and by the
+    default and target profiles) for the life of the process.
+    """
+    if embedded_profile:
+        input_profile = ImageCms.ImageCmsProfile(io.BytesIO(embedded_profile))
+    else:
+        input_profile = cmyk_profile
+    if not srgb_profile:
+        # Use the built in default sRGB color space
+        srgb_profile = ImageCms.createProfile('sRGB')
+    return ImageCms.buildTransform(input_profile, srgb_profile, mode, 'RGB', renderingIntent=0)
 
 
 # Would be nice if we could just:
@@ -279,42 +696,252 @@ def guess_border(image: Image):
           shade in the image.
     """
 
+    return vote_border(image.getpixel(loc) for loc in corner_locations(image.size))
+
+
+def corner_locations(size: Tuple[int, int]):
+    """The coordinates of the corner pixels of an image of the given size"""
+    width, height = size
+    return (0, 0), (0, height - 1), (width - 1, 0), (width - 1, height - 1)
+
+
+def vote_border(corners):
+    """Pick a border color from corner pixel values, as described in `guess_border`"""
+
     def pixel_order(pixel, frequency):
         if not isinstance(pixel, int):
             pixel = sum(pixel) / len(pixel)
         return frequency + 1.0 / (257 - pixel)
 
-    corners = tuple(
-        image.getpixel(loc) for loc in (
-            (0, 0), (0, image.height - 1),
-            (image.width - 1, 0), (image.width - 1, image.height - 1)
-        )
-    )
     vote = {}
     for corner in corners:
         vote[corner] = vote.get(corner, 0) + 1
     return sorted(vote.keys(), key=lambda x: pixel_order(x, vote[x]))[-1]
 
 
-def process_final_image(
+def plan_border(corners, trans_background: bool = False) -> Tuple[Literal['RGBA', 'RGB'], tuple]:
+    """
+    Plan the padding of an output square from just the corner pixels of the scaled
+    image, in whatever mode it is in: the canvas mode, and the border color (see
+    `vote_border`) widened to RGB, or made transparent for `trans_background`.
+    Nothing else about the image needs to be looked at.
+    """
+    border_color = vote_border(corners)
+    if isinstance(border_color, int):
+        border_color = (border_color,)
+    if len(border_color) < 3:
+        # A grayscale image (maybe with alpha), but the output is RGB
+        border_color = border_color[:1] * 3
+    if trans_background:
+        return 'RGBA', tuple(border_color[0:3]) + (0,)
+    return 'RGB', tuple(border_color[0:3])
+
+
+def output_filename(filename: os.PathLike, output_dir: os.PathLike, image_extension: str):
+    """Return the path that the output for `filename` will be written to"""
+    ext_file = ".".join([os.fspath(filename).rsplit(".", 1)[0], image_extension])
+    return pathlib.Path(os.path.join(output_dir, os.path.basename(ext_file)))
+
+
+def pad_to_square(img_scaled: Image, output_size: int, trans_background: bool = False):
+    """Pad an image already scaled to fit an output_size square with a guessed border color"""
+    if img_scaled.width == img_scaled.height:
+        return img_scaled
+    mode, border_color = plan_border(
+        (img_scaled.getpixel(loc) for loc in corner_locations(img_scaled.size)), trans_background)
+    save_image = Image.new(mode, (output_size, output_size), border_color)
+    if img_scaled.width > img_scaled.height:
+        y_offset = (output_size - img_scaled.height) // 2
+        save_image.paste(img_scaled, (0, y_offset))
+    else:
+        x_offset = (output_size - img_scaled.width) // 2
+        save_image.paste(img_scaled, (x_offset, 0))
+    return save_image
+
+
+def composite_to_square(
         image: Image,
+        mask: Image,
+        background: tuple,
+        output_size: int,
+        trans_background: bool = False,
+):
+    """
+    Scale an image and its mask to fit an output_size square, then composite them
+    straight onto the padded output canvas. This gives the result of `mask_image`
+    followed by scaling and `pad_to_square` without building a full size composite
+    or any intermediate canvas.
+    """
+    img_scaled = ImageOps.contain(image, size=(output_size, output_size))
+    mask_scaled = ImageOps.contain(mask, size=(output_size, output_size))
+    mode = 'RGBA' if len(background) > 3 else 'RGB'
+    if mode == 'RGBA':
+        # Over a transparent background, the mask is just the alpha channel. Blending the
+        # colors with the background instead would fringe the scaled edges with it.
+        img_scaled = img_scaled.convert('RGBA')
+        img_scaled.putalpha(mask_scaled)
+
+    def composite_onto(canvas: Image, dest: Tuple[int, int], box: Optional[Tuple[int, int, int, int]] = None):
+        layer = img_scaled.crop(box) if box else img_scaled
+        if mode == 'RGBA':
+            canvas.alpha_composite(layer, dest=dest)
+        else:
+            canvas.paste(layer, dest, mask_scaled.crop(box) if box else mask_scaled)
+
+    if img_scaled.width == img_scaled.height:
+        canvas = Image.new(mode, img_scaled.size, background)
+        composite_onto(canvas, (0, 0))
+        return canvas
+
+    # The border is guessed from the corners of the composite, which we make one pixel at a time
+    corners = []
+    for loc in corner_locations(img_scaled.size):
+        pixel = Image.new(mode, (1, 1), background)
+        composite_onto(pixel, (0, 0), loc + (loc[0] + 1, loc[1] + 1))
+        corners.append(pixel.getpixel((0, 0)))
+    canvas_mode, border_color = plan_border(corners, trans_background)
+    canvas = Image.new(canvas_mode, (output_size, output_size), border_color)
+    if img_scaled.width > img_scaled.height:
+        offset = (0, (output_size - img_scaled.height) // 2)
+    else:
+        offset = ((output_size - img_scaled.width) // 2, 0)
+    canvas.paste(background, offset + (offset[0] + img_scaled.width, offset[1] + img_scaled.height))
+    composite_onto(canvas, offset)
+    return canvas
+
+
+def render_square(info: ImageInfo, output_size: int, trans_background: bool = False):
+    """Render an image (masked or not) as an output_size square"""
+    if info.mask is not None:
+        return composite_to_square(info.image, info.mask.image, info.background, output_size, trans_background)
+    return pad_to_square(info.thumbnail(output_size), output_size, trans_background)
+
+
+def render_squares(
+        info: ImageInfo,
+        output_sizes: Sequence[int],
+        trans_background: bool = False,
+        timer: Optional[StageTimer] = None,
+):
+    """
+    Render an image as a square of each of output_sizes (largest first), scaling each
+    one down from the one before rather than going back to the source image
+    """
+    square = None
+    for output_size in output_sizes:
+        with timed(timer, 'render', pixels=output_size * output_size):
+            if square is None:
+                square = render_square(info, output_size, trans_background)
+            else:
+                square = square.resize((output_size, output_size), Image.LANCZOS)
+        yield square
+
+
+def sized_outputs(
+        filename: os.PathLike,
+        output_dir: os.PathLike,
+        output_size: Union[int, Sequence[int]],
+        image_extension: str,
+):
+    """
+    The size and path of each output to make for `filename`, largest first. A single
+    output_size goes in output_dir, but each of a list of sizes gets a subdirectory
+    named for the size.
+    """
+    if isinstance(output_size, int):
+        return [(output_size, output_filename(filename, output_dir, image_extension))]
+    return [
+        (size, output_filename(filename, os.path.join(output_dir, str(size)), image_extension))
+        for size in sorted(output_size, reverse=True)
+    ]
+
+
+class ImageWriter:
+    """
+    A write-behind stage for output images: encoding and writing happen on a small
+    thread pool (Pillow's encoders release the GIL) while the caller moves on to the
+    next image. No more than `max_bytes` of image data is queued at once, `write`
+    blocks until there is room. Encoding and writing are timed on `timer`, if given.
+    """
+    def __init__(self, max_bytes: int = DEFAULT_WRITE_BUFFER, threads: int = 2, timer: Optional[StageTimer] = None):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.max_bytes = max_bytes
+        self.queued = 0
+        self.room = threading.Condition()
+        self.timer = timer
+
+    @staticmethod
+    def cost(data: Union[Image, bytes]):
+        """The memory held by a queued image (uncompressed) or already encoded image"""
+        if isinstance(data, bytes):
+            return len(data)
+        return data.width * data.height * len(data.getbands())
+
+    def write(self, data: Union[Image, bytes], outfile: os.PathLike, save_params: Optional[Dict[str, str]] = None):
+        """Queue an image, or its already encoded bytes, to be written to outfile. Returns a Future."""
+        cost = self.cost(data)
+        with self.room:
+            # An image bigger than the whole buffer gets to go through on its own
+            self.room.wait_for(lambda: self.queued == 0 or self.queued + cost <= self.max_bytes)
+            self.queued += cost
+        return self.pool.submit(self._write, data, outfile, save_params, cost)
+
+    def _write(self, data: Union[Image, bytes], outfile: os.PathLike, save_params: Optional[Dict[str, str]], cost: int):
+        try:
+            if isinstance(data, bytes):
+                write_bytes(data, outfile, self.timer)
+            else:
+                encode_image(data, outfile, save_params, self.timer)
+        finally:
+            with self.room:
+                self.queued -= cost
+                self.room.notify_all()
+
+    def close(self):
+        """Wait for all queued writes to finish"""
+        self.pool.shutdown(wait=True)
+
+
+def encode_image(image: Image, outfile: os.PathLike, save_params: Optional[Dict[str, str]] = None,
+                 timer: Optional[StageTimer] = None):
+    """Encode and write an image, timed as "encode" on `timer`"""
+    with timed(timer, 'encode', pixels=image.width * image.height) as counts:
+        image.save(outfile, **(save_params or {}))
+        if timer:
+            counts['bytes'] = os.path.getsize(outfile)
+
+
+def write_bytes(data: bytes, outfile: os.PathLike, timer: Optional[StageTimer] = None):
+    """Write an already encoded image, timed as "write" on `timer`"""
+    with timed(timer, 'write', nbytes=len(data)):
+        with open(outfile, 'wb') as fh:
+            fh.write(data)
+
+
+def process_final_image(
+        image: Union[Image, ImageInfo],
         img_hash: FuzzyImageRecall,
         filename=None,
         output_dir: os.PathLike = DEFAULT_OUTDIR,
-        output_size=DEFAULT_SIZE,
+        output_size: Union[int, Sequence[int]] = DEFAULT_SIZE,
         keep: bool = False,
         trans_background: bool = False,
         image_extension: str = 'png',
         find_duplicates: bool = False,
         save_params: Optional[Dict[str, str]] = None,
+        sources: Optional[List[os.PathLike]] = None,
+        writer: Optional[ImageWriter] = None,
+        timer: Optional[StageTimer] = None,
+        full: bool = True,
 ):
     """
     Write the image out to disk, pending some last checks such as for duplicates.
-    :param image: The image to save
+    :param image: The image to save, or an ImageInfo whose cached hash and thumbnail are used
     :param img_hash: The history tracking hash
     :param filename: Image filename
     :param output_dir: Directory to save in
-    :param output_size: Maximum dimension for the saved image max(width, height)
+    :param output_size: Maximum dimension for the saved image max(width, height), or
+      a list of them to save one of each (see `sized_outputs`)
     :param keep: Whether to keep existing files or overwrite
     :param trans_background: Should background be transparent?
     :param image_extension: The filename extension (without ".") for image writing
@@ -322,45 +949,47 @@ def process_final_image(
     :param save_params: a dictionary of parameters to the save encoder.
       see https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html
       for details.
-    :return: filename written (or existing if keep is True)
+    :param sources: the input files that the image was produced from, used to
+      look up and record its hash in a persistent history
+    :param writer: an ImageWriter to queue the writes on, in which case the returned
+      status has the writes' Futures as 'writes'
+    :param timer: a StageTimer to time rendering and encoding on (an ImageInfo's
+      own timer covers decoding and hashing)
+    :param full: whether output_size has every size of the run in it, or only the
+      smaller ones that the image is big enough for (see `FuzzyImageRecall.claim`)
+    :return: filename written (or existing if keep is True), the largest if there are several
     """
 
     assert output_size, "Must have non-zero output size."
 
-    ext_file = ".".join([os.fspath(filename).rsplit(".", 1)[0], image_extension])
-    outfile = pathlib.Path(os.path.join(output_dir, os.path.basename(ext_file)))
+    outputs = sized_outputs(filename, output_dir, output_size, image_extension)
+    outfile = outputs[0][1]
 
-    if image in img_hash:
+    info = image if isinstance(image, ImageInfo) else ImageInfo(file_path=filename, image=image, timer=timer)
+    key = info.fuzzy_key(img_hash, sources)
+    outputs = img_hash.unclaimed(key, outputs)
+    if not outputs:
         return {'status': 'duplicate', 'outfile': outfile}
-    img_hash.add(image)
+    img_hash.claim(key, outputs, full)
     if find_duplicates:
         return {'status': 'normal', 'outfile': outfile}
 
-    if keep and outfile.exists():
+    if keep and all(path.exists() for _, path in outputs):
         return {'status': 'skipped', 'outfile': outfile}
 
-    if 0 in image.size or 1 in image.size:
+    if 0 in info.size or 1 in info.size:
         return {'status': 'small', 'outfile': outfile}
 
-    img_scaled = ImageOps.contain(image, size=(output_size, output_size))
-    if img_scaled.width == img_scaled.height:
-        save_image = img_scaled
-    else:
-        border_color = guess_border(img_scaled)
-        if not ImageInfo.is_color(img_scaled):
-            border_color = (border_color, border_color, border_color)
-        mode: Literal['RGBA', 'RGB'] = 'RGB'
-        if trans_background:
-            mode = 'RGBA'
-            border_color = border_color[0:3] + (0,)
-        save_image = Image.new(mode, (output_size, output_size), border_color)
-        if img_scaled.width > img_scaled.height:
-            y_offset = (output_size - img_scaled.height) // 2
-            save_image.paste(img_scaled, (0, y_offset))
+    info.load()
+    writes = []
+    squares = render_squares(info, [size for size, _ in outputs], trans_background, timer)
+    for (_, path), square in zip(outputs, squares):
+        if writer is not None:
+            writes.append(writer.write(square, path, save_params))
         else:
-            x_offset = (output_size - img_scaled.width) // 2
-            save_image.paste(img_scaled, (x_offset, 0))
-    save_image.save(outfile, **(save_params or {}))
+            encode_image(square, path, save_params, timer)
+    if writer is not None:
+        return {'status': 'normal', 'outfile': outfile, 'writes': writes}
     return {'status': 'normal', 'outfile': outfile}
 
 
@@ -381,6 +1010,164 @@ def mask_image(image: Image, mask: Image, background: tuple):
     return img_masked
 
 
+def mask_background(mode: str, trans_background: bool = False):
+    """The background color that a masked image in the given mode is composited onto"""
+    white_color = white_pixel(mode)
+    if len(white_color) == 3 and trans_background:
+        white_color = white_color + (0,)
+    return white_color
+
+
+@dataclasses.dataclass
+class PairJob:
+    """
+    A unit of work for the `--jobs` process pool: an image file and, optionally, the
+    mask file that the parent process paired it with. The worker decodes the files
+    itself, unless the parent already had to (to pair them, or to convert from CMYK),
+    in which case the pixels travel along as `image` and `mask`.
+    """
+    image_path: os.PathLike
+    mask_path: Optional[os.PathLike]
+    filename: os.PathLike
+    output_dir: os.PathLike
+    output_size: Union[int, List[int]]
+    keep: bool
+    trans_background: bool
+    image_extension: str
+    find_duplicates: bool
+    save_params: Optional[Dict[str, str]]
+    convert_cmyk: bool = False
+    draft: bool = False
+    key: Optional[Tuple[int, ...]] = None
+    srgb_profile: Optional[os.PathLike] = None
+    cmyk_profile: Optional[os.PathLike] = None
+    timings: bool = False
+    image: Optional[Image] = None
+    mask: Optional[Image] = None
+
+
+def process_pair_job(job: PairJob):
+    """
+    The worker side of `--jobs`: decode, mask and render one pair, but leave the
+    duplicate decision to the parent. The result carries the fuzzy hash `key` and,
+    if the image needs writing, the path and encoded image of each output as `data`.
+    If `timings` was asked for, it also carries the worker's `StageTimer` totals as
+    'timings'.
+    """
+    timer = StageTimer() if job.timings else None
+    result = process_pair(job, sized_outputs(job.filename, job.output_dir, job.output_size, job.image_extension), timer)
+    if timer:
+        result['timings'] = timer.stages
+    return result
+
+
+def process_pair(job: PairJob, outputs: List[Tuple[int, pathlib.Path]], timer: Optional[StageTimer] = None):
+    """The body of `process_pair_job`"""
+    outfile = outputs[0][1]
+
+    def image_info(path: os.PathLike, image: Optional[Image]):
+        if image is not None:
+            return ImageInfo(file_path=path, image=image, timer=timer)
+        return ImageInfo.get_image_info(path, timer=timer)
+
+    try:
+        info = image_info(job.image_path, job.image)
+        if job.draft:
+            info.draft(outputs[0][0])
+        if job.convert_cmyk:
+            info.from_cmyk_to_rgb(job.srgb_profile, job.cmyk_profile)
+        if job.mask_path is not None:
+            mask = image_info(job.mask_path, job.mask)
+            info = info.masked(mask, mask_background(info.image.mode, job.trans_background))
+        key = job.key if job.key is not None else info.fuzzy_key(FuzzyImageRecall())
+        result = {'status': 'normal', 'outfile': outfile, 'key': key, 'outputs': outputs}
+        if job.find_duplicates:
+            return result
+        if job.keep and all(path.exists() for _, path in outputs):
+            return dict(result, status='skipped')
+        if 0 in info.size or 1 in info.size:
+            return dict(result, status='small')
+        info.load()
+        image_format = Image.registered_extensions().get(outfile.suffix.lower())
+        data = []
+        squares = render_squares(info, [size for size, _ in outputs], job.trans_background, timer)
+        for (_, path), square in zip(outputs, squares):
+            buffer = io.BytesIO()
+            with timed(timer, 'encode', pixels=square.width * square.height) as counts:
+                square.save(buffer, format=image_format, **(job.save_params or {}))
+                counts['bytes'] = buffer.tell()
+            data.append((path, buffer.getvalue()))
+        return dict(result, data=data)
+    except OSError as err:
+        return {'status': 'failed', 'outfile': outfile, 'error': err}
+
+
+def merge_pair_result(
+        result: Dict[str, Any],
+        history: FuzzyImageRecall,
+        keep: bool = False,
+        sources: Optional[List[os.PathLike]] = None,
+        writer: Optional[ImageWriter] = None,
+        timer: Optional[StageTimer] = None,
+        full: bool = True,
+):
+    """
+    The parent side of `--jobs`: make the duplicate decision for a worker result, in
+    input order, and write the encoded image at each size where it survives. Mirrors
+    the order of checks in `process_final_image`, including queueing the write on
+    `writer` and what `full` means. The worker's timings, if any, are added to `timer`.
+    """
+    if timer and 'timings' in result:
+        timer.merge(result['timings'])
+    if result['status'] == 'failed':
+        print(f"  Error processing image data: {result['error']!r}")
+        return None
+    outfile = result['outfile']
+    history.remember_key(sources, result['key'])
+    outputs = history.unclaimed(result['key'], result['outputs'])
+    if not outputs:
+        return {'status': 'duplicate', 'outfile': outfile}
+    history.claim(result['key'], outputs, full)
+    if 'data' in result:
+        kept = {path for _, path in outputs}
+        result_data = [(path, data) for path, data in result['data'] if path in kept]
+        if keep and all(path.exists() for path, _ in result_data):
+            return {'status': 'skipped', 'outfile': outfile}
+        if writer is not None:
+            writes = [writer.write(data, path) for path, data in result_data]
+            return {'status': result['status'], 'outfile': outfile, 'writes': writes}
+        for path, data in result_data:
+            write_bytes(data, path, timer)
+    return {'status': result['status'], 'outfile': outfile}
+
+
+def replay_output(
+        entry: Dict[str, Any],
+        outputs: List[Tuple[int, pathlib.Path]],
+        history: FuzzyImageRecall,
+        find_duplicates: bool = False,
+        full: bool = True,
+):
+    """
+    Stand in for `process_final_image` on outputs that a `RunManifest` shows to be
+    unchanged: the duplicate decision is made again from the recorded hash, in input
+    order, but nothing is decoded or written. Returns None if the outputs were
+    duplicates last time but no longer are (at some size), and so have to be made
+    after all.
+    """
+    key = history.parse_repr(entry['key'])
+    outfile = outputs[0][1]
+    kept = history.unclaimed(key, outputs)
+    if not kept:
+        return {'status': 'duplicate', 'outfile': outfile}
+    if entry['status'] == 'duplicate' or len(kept) < len(outputs):
+        return None
+    history.claim(key, kept, full)
+    if find_duplicates or entry['status'] != 'normal':
+        return {'status': entry['status'], 'outfile': outfile}
+    return {'status': 'unchanged', 'outfile': outfile}
+
+
 def get_filename_key(fname: os.PathLike):
     """Return a filename key that correctly sorts numbered files"""
 
@@ -397,6 +1184,218 @@ def get_filename_key(fname: os.PathLike):
     return re.sub(r'-(\d+)\.', replacer, path_str)
 
 
+class HeaderCache:
+    """
+    What the header of each image file in one directory says about it (format, mode
+    and size, or why it is not an image we can read), so that files we will skip
+    cost one small read instead of a full open. Entries are kept by file name along
+    with the size and mtime they were read at. With `persist`, they are also saved to
+    a file in the directory so that a re-run does not have to open those files at all.
+    """
+    cache_name = ".process-art-headers.json"
+    sniff_bytes = 64 * 1024
+
+    def __init__(self, directory: os.PathLike, persist: bool = False):
+        self.path = pathlib.Path(directory) / self.cache_name
+        self.persist = persist
+        self.entries = {}
+        self.changed = False
+        if persist and self.path.exists():
+            try:
+                self.entries = json.loads(self.path.read_text())
+            except (OSError, ValueError):
+                pass
+
+    @classmethod
+    def sniff(cls, img_path: os.PathLike):
+        """Read the header of an image file, from just its first few KB where possible"""
+        with open(img_path, 'rb') as fh:
+            head = fh.read(cls.sniff_bytes)
+        try:
+            with Image.open(io.BytesIO(head)) as image:
+                return {'format': image.format, 'mode': image.mode, 'width': image.width, 'height': image.height}
+        except (UnidentifiedImageError, OSError, SyntaxError, ValueError):
+            pass
+        # The header didn't fit (TIFF often keeps it at the end) or this isn't an image
+        # at all. Either way, let Pillow look at the whole file.
+        try:
+            with Image.open(os.fspath(img_path)) as image:
+                return {'format': image.format, 'mode': image.mode, 'width': image.width, 'height': image.height}
+        except UnidentifiedImageError as err:
+            return {'error': repr(err)}
+
+    def get(self, img_path: pathlib.Path, stat: Optional[os.stat_result] = None):
+        """
+        Return the (possibly cached) header info for a file in this directory, given
+        its `stat` if that is already known
+        """
+        stat = stat or img_path.stat()
+        entry = self.entries.get(img_path.name)
+        if entry and entry['file_size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry
+        entry = dict(self.sniff(img_path), file_size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        self.entries[img_path.name] = entry
+        self.changed = True
+        return entry
+
+    def save(self):
+        """Save the cache if it changed, quietly giving up on read-only directories"""
+        if self.persist and self.changed:
+            try:
+                self.path.write_text(json.dumps(self.entries))
+                self.changed = False
+            except OSError:
+                pass
+
+
+class RunManifest:
+    """
+    A record, kept in the output directory, of what earlier runs did: which adjacent
+    source files paired up as image and mask, and which output was made from which
+    sources, with which settings and what fuzzy hash. With it, a re-run can decide
+    unchanged pairs and skip unchanged outputs without decoding anything, while an
+    output whose sources or settings changed is made again.
+
+    A source counts as unchanged if its size and mtime match what was recorded or,
+    failing that, its content digest does (so copying or touching files costs a
+    read, but not a re-render).
+    """
+    manifest_name = ".process-art-manifest.json"
+
+    def __init__(self, output_dir: os.PathLike, params: Dict[str, Any]):
+        self.path = pathlib.Path(output_dir) / self.manifest_name
+        # Round-tripped through JSON so that it compares equal to what we load
+        self.params = json.loads(json.dumps(params, default=str))
+        self.pairs = {}
+        self.outputs = {}
+        self.digests = {}
+        self.changed = False
+        if self.path.exists():
+            try:
+                manifest = json.loads(self.path.read_text())
+                self.pairs = manifest['pairs']
+                self.outputs = manifest['outputs']
+            except (OSError, ValueError, KeyError):
+                pass
+
+    def _digest(self, path: str, stat: os.stat_result):
+        memo_key = (path, stat.st_size, stat.st_mtime_ns)
+        if memo_key not in self.digests:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(2**20), b''):
+                    digest.update(chunk)
+            self.digests[memo_key] = digest.hexdigest()
+        return self.digests[memo_key]
+
+    def signature(self, source: os.PathLike):
+        """Identify a source file by path, size, mtime and content digest"""
+        path = os.path.abspath(source)
+        stat = os.stat(path)
+        return {'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': self._digest(path, stat)}
+
+    def unchanged(self, signature: Dict[str, Any]):
+        """Is the file that `signature` was recorded for still the same?"""
+        try:
+            stat = os.stat(signature['path'])
+        except OSError:
+            return False
+        if stat.st_size != signature['size']:
+            return False
+        return stat.st_mtime_ns == signature['mtime_ns'] or self._digest(signature['path'], stat) == signature['digest']
+
+    @staticmethod
+    def _pair_name(image_path: os.PathLike, mask_path: os.PathLike):
+        return f"{os.path.abspath(image_path)}\n{os.path.abspath(mask_path)}"
+
+    def paired(self, image_path: os.PathLike, mask_path: os.PathLike):
+        """Did `mask_path` mask `image_path` last time? None if unknown or either file changed."""
+        entry = self.pairs.get(self._pair_name(image_path, mask_path))
+        if not entry or entry['profiles'] != self.params['profiles']:
+            return None
+        if not (self.unchanged(entry['image']) and self.unchanged(entry['mask'])):
+            return None
+        return entry['masked']
+
+    def record_pair(self, image_path: os.PathLike, mask_path: os.PathLike, masked: bool):
+        """Record whether `mask_path` masked `image_path` (see `paired`)"""
+        self.pairs[self._pair_name(image_path, mask_path)] = {
+            'image': self.signature(image_path),
+            'mask': self.signature(mask_path),
+            'profiles': self.params['profiles'],
+            'masked': masked,
+        }
+        self.changed = True
+
+    def current_output(self, outfiles: List[pathlib.Path], sources: List[os.PathLike]):
+        """
+        The recorded entry for the first of `outfiles`, if it was last made from these
+        same, unchanged, sources with the same settings, and all of `outfiles` are
+        still there if images were written. Otherwise None.
+        """
+        outfile = outfiles[0]
+        entry = self.outputs.get(outfile.name)
+        if not entry or entry['params'] != self.params:
+            return None
+        if [s['path'] for s in entry['sources']] != [os.path.abspath(s) for s in sources]:
+            return None
+        if entry['status'] == 'normal' and not all(path.exists() for path in outfiles):
+            return None
+        if not all(self.unchanged(signature) for signature in entry['sources']):
+            return None
+        return entry
+
+    def record_output(self, outfile: pathlib.Path, sources: List[os.PathLike], status: str, key: Tuple[int, ...]):
+        """Record how `outfile` was made (see `current_output`)"""
+        self.outputs[outfile.name] = {
+            'sources': [self.signature(source) for source in sources],
+            'params': self.params,
+            'status': status,
+            'key': FuzzyImageRecall.key_repr(key),
+        }
+        self.changed = True
+
+    def save(self):
+        """Save the manifest if it changed, quietly giving up on read-only directories"""
+        if self.changed:
+            try:
+                self.path.write_text(json.dumps({'pairs': self.pairs, 'outputs': self.outputs}))
+                self.changed = False
+            except OSError:
+                pass
+
+
+def iter_image_files(img_dir: os.PathLike):
+    """The paths of the files that `iter_image_entries` finds"""
+    for entry in iter_image_entries(img_dir):
+        yield pathlib.Path(entry.path)
+
+
+def iter_image_entries(img_dir: os.PathLike):
+    """
+    Generate the files (with an extension) under `img_dir`, sorted with `get_filename_key`,
+    one directory at a time so that processing can start before the whole tree is read.
+    These are the `os.DirEntry` objects from the scan, so that their stat is only fetched
+    once (and not at all on Windows, where the scan returns it).
+
+    Sub-directories sort among the files as though by their path, so the order is the
+    same as sorting every path in the tree at once.
+    """
+    with os.scandir(img_dir) as scan:
+        entries = []
+        for entry in scan:
+            if entry.is_dir(follow_symlinks=False):
+                entries.append((get_filename_key(entry.name) + os.sep, entry))
+            elif "." in entry.name and entry.name != HeaderCache.cache_name and entry.is_file():
+                entries.append((get_filename_key(entry.name), entry))
+    entries.sort(key=lambda keyed: keyed[0])
+    for key, entry in entries:
+        if key.endswith(os.sep):
+            yield from iter_image_entries(entry.path)
+        else:
+            yield entry
+
+
 def summarize_status(status: Dict[str, int]):
     """Summarize image processing status info"""
 
@@ -407,6 +1406,7 @@ def summarize_status(status: Dict[str, int]):
         'cmyk': 'CMYK color space images converted',
         'masked': 'Masked images composited',
         'skipped': 'Skipped',
+        'unchanged': 'Unchanged since the last run',
         'duplicate': 'Duplicate image',
         'failed': 'Processing failed',
         'normal': 'Images with no mask processed',
@@ -416,7 +1416,8 @@ def summarize_status(status: Dict[str, int]):
     for reason in sorted(list(status.keys()) + ['total']):
         label = status_info.get(reason, reason)
         if reason == 'total':
-            count = status.get('masked', 0) + status.get('normal', 0)
+            # Unchanged images were processed by an earlier run, but still count
+            count = sum(status.get(processed, 0) for processed in ('masked', 'normal', 'unchanged'))
         else:
             count = status[reason]
         print(f"{label}: {count}")
@@ -425,7 +1426,7 @@ def summarize_status(status: Dict[str, int]):
 def process_img_dir(
         img_dir: os.PathLike,
         outdir: os.PathLike = DEFAULT_OUTDIR,
-        output_size: int = DEFAULT_SIZE,
+        output_size: Union[int, Sequence[int]] = DEFAULT_SIZE,
         minimum_quality: float = DEFAULT_QUALITY,
         all_images: bool = False,
         unmasked: bool = False,
@@ -438,13 +1439,19 @@ def process_img_dir(
         srgb_profile: Optional[Union[ImageCms.ImageCmsProfile, os.PathLike]] = None,
         cmyk_profile: Optional[Union[ImageCms.ImageCmsProfile, os.PathLike]] = None,
         verbose: bool = False,
+        jobs: int = 1,
+        header_cache: bool = False,
+        write_buffer: int = DEFAULT_WRITE_BUFFER,
+        incremental: bool = False,
+        timer: Optional[StageTimer] = None,
 ):
     """
     Find and label all images in `img_dir`
     :param img_dir: the path to a directory containing consectuively numbered image files from a PDF
         (extracted using pdfimages)
     :param outdir: optional directory to store results
-    :param output_size: the size (in width and height) of output images
+    :param output_size: the size (in width and height) of output images, or a list of
+        sizes to make each image in, from a single decode, in a subdirectory per size
     :param minimum_quality: float representing the lowest fraction of output_size images to keep
     :param all_images: process images that lack a mask
     :param unmasked: only process unmasked images
@@ -457,7 +1464,14 @@ def process_img_dir(
     :param srgb_profile: profile or file path to the profile to use in converting CMYK
     :param cmyk_profile: profile or file path to the profile to use for CMYK files with none
     :param verbose: Produce verbose output
-    :return: nothing
+    :param jobs: Number of worker processes to mask, scale and encode images with
+    :param header_cache: Save what image headers say in each input directory, for re-runs
+    :param write_buffer: Bytes of finished images that may wait to be written in the
+        background, or 0 to write each one before moving on
+    :param incremental: Keep a `RunManifest` in outdir, and skip the outputs it shows
+        to be unchanged since the last run
+    :param timer: A StageTimer to time each stage of processing on
+    :return: the status counts that were summarized
     """
 
     stats = {}
@@ -465,23 +1479,54 @@ def process_img_dir(
     def bump(status: str):
         stats[status] = stats.get(status, 0) + 1
 
+    reports = collections.deque()
+
     def img_report(img_status: Optional[Dict[str, Any]]):
+        # Statuses are reported in order, so they queue behind any write still in progress
+        reports.append(img_status)
+        flush_reports()
+
+    def flush_reports(wait: bool = False):
+        while reports:
+            img_status = reports[0]
+            writes = img_status.get('writes', []) if img_status else []
+            if not wait and not all(write.done() for write in writes):
+                break
+            try:
+                for write in writes:
+                    write.result()
+            except Exception as err:
+                print(f"  Error processing image data: {err!r}")
+                img_status = None
+            reports.popleft()
+            report(img_status)
+
+    def report(img_status: Optional[Dict[str, Any]]):
         if not img_status:
             bump('failed')
         else:
             status_type = img_status['status']
             bump(status_type)
+            if manifest and not find_duplicates and status_type in ('normal', 'small', 'duplicate') and 'key' in img_status:
+                manifest.record_output(img_status['outfile'], img_status['sources'], status_type, img_status['key'])
             if find_duplicates:
                 if status_type == 'duplicate':
                     print(img_status['outfile'])
             elif verbose:
                 print(f"  image processing {status_type}, outfile: {img_status['outfile']}")
 
-    small_image = output_size * minimum_quality
+    if not isinstance(output_size, int):
+        output_size = sorted(set(output_size), reverse=True)
+        if not find_duplicates:
+            for size in output_size:
+                os.makedirs(os.path.join(outdir, str(size)), exist_ok=True)
+    largest_size = output_size if isinstance(output_size, int) else output_size[0]
+    smallest_size = output_size if isinstance(output_size, int) else output_size[-1]
+    small_image = smallest_size * minimum_quality
     previous = None
     history = history or FuzzyImageRecall()
+    writer = ImageWriter(write_buffer, timer=timer) if write_buffer and not find_duplicates else None
     process_args = dict(
-        output_size=output_size,
         output_dir=outdir,
         keep=keep,
         trans_background=trans_background,
@@ -489,69 +1534,295 @@ def process_img_dir(
         image_extension=image_extension,
         save_params=save_params,
         find_duplicates=find_duplicates,
+        writer=writer,
+        timer=timer,
     )
-    if verbose:
-        print(f"Starting on {img_dir} -> {outdir}")
-    img_dir = pathlib.Path(img_dir)  # ensure that it's not a string
-    all_files = (pathlib.Path(f) for f in img_dir.glob(os.path.join('**', '*.*')) if os.path.isfile(f))
-    for img_file in sorted(all_files, key=get_filename_key):
-        if not find_duplicates:
-            print(f" input file: {img_file}")
-        if "." not in str(img_file):
-            if not find_duplicates and verbose:
-                print(f"  skipping unknown file type for {img_file}")
-            bump('unknown')
-            continue
-        img_extension = str(img_file).lower().rsplit(".", 1)[-1]
-        if img_extension == "ccitt":
-            bump('unsupported')
-            if not find_duplicates:
-                print(f"  skipping {img_file} as we don't support CCITT format TIFF compression")
-            continue
-        elif img_extension == "params":
-            bump('unsupported')
-            if not find_duplicates:
-                print(f"  skipping {img_file} as we don't support PARAMS files")
-            continue
-        try:
-            info = ImageInfo.get_image_info(img_file)
-        except UnidentifiedImageError as err:
-            bump('unsupported')
-            if not find_duplicates:
-                print(f"  skipping {img_file}: {err!r}")
-            continue
-        if max(info.width, info.height) <= small_image:
-            bump('small')
+    pool = None
+    headers = {}
+    pending = collections.deque()
+    manifest = None
+    if incremental:
+        manifest = RunManifest(outdir, dict(
+            output_size=output_size,
+            image_extension=image_extension,
+            save_params=save_params,
+            trans_background=trans_background,
+            profiles=[srgb_profile, cmyk_profile],
+            key_version=FuzzyImageRecall.key_version,
+        ))
+
+    def merge_next():
+        sources, full, future = pending.popleft()
+        result = future.result()
+        if verbose and 'key' in result:
+            print(f"  image fuzzy hash: {history.key_repr(result['key'])}")
+        img_status = merge_pair_result(
+            result, history, keep=keep, sources=sources, writer=writer, timer=timer, full=full)
+        if img_status:
+            img_status.update(sources=sources, key=result['key'])
+        img_report(img_status)
+
+    def sizes_for(image_info: ImageInfo):
+        # Each size only gets the images that a run at just that size would have kept
+        if isinstance(output_size, int):
+            return output_size
+        return [size for size in output_size if max(image_info.size) > size * minimum_quality]
+
+    def emit(
+            image_info: ImageInfo,
+            mask_info: Optional[ImageInfo] = None,
+            drafted: bool = False,
+    ):
+        filename = os.path.join(outdir, os.path.basename(image_info.file_path))
+        sources = [image_info.file_path] + ([mask_info.file_path] if mask_info else [])
+        image_sizes = sizes_for(image_info)
+        # An image too small for the largest sizes only counts as a duplicate at the smaller ones
+        full = isinstance(output_size, int) or len(image_sizes) == len(output_size)
+        if manifest:
+            outputs = sized_outputs(filename, outdir, image_sizes, image_extension)
+            entry = manifest.current_output([path for _, path in outputs], sources)
+            img_status = None
+            if entry:
+                # Duplicates are decided in input order, so what the workers have comes first
+                while pending:
+                    merge_next()
+                img_status = replay_output(entry, outputs, history, find_duplicates, full)
+            if img_status:
+                img_report(img_status)
+                return
+        if image_info.image.mode == 'CMYK' and not pool:
+            # Not converted yet, because the manifest already knew how it paired (or
+            # it is the last file, and never was paired)
+            image_info.from_cmyk_to_rgb(srgb_profile, cmyk_profile)
+        if pool:
+            pending.append((sources, full, pool.submit(process_pair_job, PairJob(
+                image_path=image_info.file_path,
+                mask_path=mask_info.file_path if mask_info else None,
+                filename=filename,
+                output_dir=outdir,
+                output_size=image_sizes,
+                keep=keep,
+                trans_background=trans_background,
+                image_extension=image_extension,
+                find_duplicates=find_duplicates,
+                save_params=save_params,
+                convert_cmyk=image_info.image.mode == 'CMYK',
+                draft=drafted,
+                key=history.cached_key(sources),
+                srgb_profile=srgb_profile,
+                cmyk_profile=cmyk_profile,
+                timings=timer is not None,
+                # Whatever we already decoded (and converted) isn't done again
+                image=image_info.image if image_info.decoded else None,
+                mask=mask_info.image if mask_info and mask_info.decoded else None,
+            ))))
+            # Bound the number of in-flight results so that we don't hold a whole
+            # directory's worth of images in memory
+            while len(pending) > jobs * 4:
+                merge_next()
+            return
+        target = image_info
+        if mask_info:
+            target = image_info.masked(mask_info, mask_background(image_info.image.mode, trans_background))
+        if verbose:
+            print(f"  image fuzzy hash: {history.key_repr(target.fuzzy_key(history, sources))}")
+        img_status = safe_process_final_image(
+            target, filename=filename, sources=sources, output_size=image_sizes, full=full, **process_args)
+        if img_status and 'key' in target.cache:
+            img_status.update(sources=sources, key=target.cache['key'])
+        img_report(img_status)
+        target.release()
+
+    with contextlib.ExitStack() as cleanup:
+        # Whatever goes wrong, the writes already queued are finished before we go
+        if writer:
+            cleanup.callback(writer.close)
+        if jobs > 1:
+            pool = cleanup.enter_context(concurrent.futures.ProcessPoolExecutor(max_workers=jobs))
+        if verbose:
+            print(f"Starting on {img_dir} -> {outdir}")
+        img_dir = pathlib.Path(img_dir)  # ensure that it's not a string
+        for entry in iter_image_entries(img_dir):
+            img_file = pathlib.Path(entry.path)
             if not find_duplicates:
-                print(f"  skipping small image")
-            continue
-        if previous and not previous.is_mask:
-            filename = os.path.join(outdir, os.path.basename(previous.file_path))
+                print(f" input file: {img_file}")
+            if "." not in str(img_file):
+                if not find_duplicates and verbose:
+                    print(f"  skipping unknown file type for {img_file}")
+                bump('unknown')
+                continue
+            img_extension = str(img_file).lower().rsplit(".", 1)[-1]
+            if img_extension == "ccitt":
+                bump('unsupported')
+                if not find_duplicates:
+                    print(f"  skipping {img_file} as we don't support CCITT format TIFF compression")
+                continue
+            elif img_extension == "params":
+                bump('unsupported')
+                if not find_duplicates:
+                    print(f"  skipping {img_file} as we don't support PARAMS files")
+                continue
+            if img_file.parent not in headers:
+                headers[img_file.parent] = HeaderCache(img_file.parent, persist=header_cache)
+            header = headers[img_file.parent].get(img_file, entry.stat())
+            if 'error' in header:
+                bump('unsupported')
+                if not find_duplicates:
+                    print(f"  skipping {img_file}: {header['error']}")
+                continue
+            if max(header['width'], header['height']) <= small_image:
+                bump('small')
+                if not find_duplicates:
+                    print(f"  skipping small image")
+                continue
+            try:
+                info = ImageInfo.get_image_info(img_file, timer=timer)
+            except UnidentifiedImageError as err:
+                bump('unsupported')
+                if not find_duplicates:
+                    print(f"  skipping {img_file}: {err!r}")
+                continue
+            if previous and not previous.is_mask:
+                # An image that differs in size from the next one can't be masked by it, so
+                # it will only ever be needed at the output size
+                drafted = previous.size != info.size and previous.draft(largest_size)
+                converted = previous.image.mode == 'CMYK'
+                if converted:
+                    # Counted here, whether or not it turns out to need converting
+                    bump('cmyk')
+                paired = manifest.paired(previous.file_path, info.file_path) if manifest else None
+                if paired is None:
+                    if converted:
+                        previous.from_cmyk_to_rgb(srgb_profile, cmyk_profile)
+                    paired = previous.masked_by(info)
+                    if manifest:
+                        manifest.record_pair(previous.file_path, info.file_path, paired)
+                if paired:
+                    info.is_mask = True
+                    if not unmasked:
+                        emit(previous, info)
+                    # A mask is never the image half of a pair, so we're done with its pixels
+                    info.release()
+                elif all_images or unmasked:
+                    emit(previous, drafted=drafted)
+            if previous:
+                previous.release()
+            previous = info
+        if previous and not previous.is_mask and (unmasked or all_images):
             if previous.image.mode == 'CMYK':
                 bump('cmyk')
-                previous.from_cmyk_to_rgb(srgb_profile, cmyk_profile)
-            if previous.masked_by(info):
-                info.is_mask = True
-                if not unmasked:
-                    white_color = white_pixel(previous.image.mode)
-                    if len(white_color) == 3 and trans_background:
-                        white_color = white_color + (0,)
-                    img_masked = mask_image(previous.image, info.image, background=white_color)
-                    if verbose:
-                        print(f"  image fuzzy hash: {history.hash_repr(img_masked)}")
-                    img_report(safe_process_final_image(img_masked, filename=filename, **process_args))
-            elif all_images or unmasked:
-                if verbose:
-                    print(f"  image fuzzy hash: {history.hash_repr(previous.image)}")
-                img_report(safe_process_final_image(previous.image, filename=filename, **process_args))
-        previous = info
-    if previous and not previous.is_mask and (unmasked or all_images):
-        filename = os.path.join(outdir, os.path.basename(previous.file_path))
-        if verbose:
-            print(f"  image fuzzy hash: {history.hash_repr(previous.image)}")
-        img_report(safe_process_final_image(previous.image, filename=filename, **process_args))
+            emit(previous, drafted=previous.draft(largest_size))
+        if previous:
+            previous.release()
+        while pending:
+            merge_next()
+        flush_reports(wait=True)
+    history.flush()
+    for cache in headers.values():
+        cache.save()
+    if manifest:
+        manifest.save()
     print(f"\n{img_dir} processing complete.")
     summarize_status(stats)
+    return stats
+
+
+def parse_sizes(value: str):
+    """Parse an --output-size: a single size, or a comma-separated list of them"""
+    sizes = [int(size) for size in value.split(",")]
+    if any(size < 1 for size in sizes):
+        raise ValueError(f"Sizes must be positive: {value!r}")
+    return sizes[0] if len(sizes) == 1 else sizes
+
+
+def parse_shard(spec: str):
+    """Parse a "K/N" shard spec (the Kth of N, counting from 1) into (K, N)"""
+    match = re.fullmatch(r'(\d+)/(\d+)', spec)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise ValueError(f"Shard must be K/N, with K from 1 to N: {spec!r}")
+    return int(match.group(1)), int(match.group(2))
+
+
+def process_img_dirs(
+        image_dirs: List[os.PathLike],
+        history: FuzzyImageRecall,
+        shard: Optional[Tuple[int, int]] = None,
+        **kwargs,
+):
+    """
+    Run `process_img_dir` on each of `image_dirs` in turn, sharing `history`, or if a
+    (K, N) `shard` is given, on only every Nth of them starting from the Kth. Which
+    directories are in a shard depends only on their position in `image_dirs`.
+    :return: the hashes claimed in `history` as (directory index, hash string, outputs,
+        full), in the order they were claimed, where outputs are the [size, path] of
+        each output written (see `FuzzyImageRecall.claim`). That includes hashes that a
+        `--hash-index` already had for the same owner, which a merge still needs to see.
+    """
+    claimed = []
+    for dir_index, img_dir in enumerate(image_dirs):
+        if shard and dir_index % shard[1] != shard[0] - 1:
+            continue
+        history.claims = []
+        process_img_dir(img_dir, history=history, **kwargs)
+        claimed.extend(
+            (dir_index, history.key_repr(key), [[size, str(path)] for size, path in outputs], full)
+            for key, outputs, full in history.claims)
+    history.claims = None
+    return claimed
+
+
+def write_shard_hashes(
+        shard_file: os.PathLike,
+        shard: Tuple[int, int],
+        image_dirs: List[os.PathLike],
+        hashes: List[Tuple[int, str, List[Tuple[int, str]], bool]],
+):
+    """Save the hashes that a shard claimed (see `process_img_dirs`) for `merge_shards`"""
+    pathlib.Path(shard_file).write_text(json.dumps({
+        'shard': list(shard),
+        'image_dirs': [os.fspath(img_dir) for img_dir in image_dirs],
+        'hashes': hashes,
+    }))
+
+
+def merge_shards(shard_files: List[os.PathLike], history: FuzzyImageRecall, remove: bool = False):
+    """
+    Combine the hashes from every shard of a run, in the order that one run over all
+    of the directories would have seen them, and find the outputs that such a run
+    would have found to be duplicates. Each shard could only check for duplicates
+    among its own directories. The outputs found are removed if `remove` is set,
+    at every size that the image is a duplicate at.
+
+    With a `--duplicate-distance` this is only approximate, because a shard does not
+    record the images it dropped as near duplicates of images that turn out to be
+    duplicates themselves.
+    :return: the duplicate outputs, in order
+    """
+    shards = [json.loads(pathlib.Path(shard_file).read_text()) for shard_file in shard_files]
+    image_dirs = shards[0]['image_dirs']
+    count = shards[0]['shard'][1]
+    if any(shard['image_dirs'] != image_dirs or shard['shard'][1] != count for shard in shards):
+        raise RuntimeError("Shards must all come from runs over the same directories, with the same shard count")
+    missing = set(range(1, count + 1)) - {shard['shard'][0] for shard in shards}
+    if missing:
+        print(f"WARNING: missing shards {', '.join(f'{k}/{count}' for k in sorted(missing))}")
+
+    # A stable sort keeps each directory's hashes in the order they were added
+    hashes = sorted(itertools.chain.from_iterable(shard['hashes'] for shard in shards), key=lambda h: h[0])
+    duplicates = []
+    for _, hash_str, outputs, full in hashes:
+        key = history.parse_repr(hash_str)
+        outputs = [(size, path) for size, path in outputs]
+        kept = history.unclaimed(key, outputs)
+        if kept:
+            history.claim(key, kept, full)
+        for output in outputs:
+            if output not in kept:
+                duplicates.append(output[1])
+                if remove and os.path.exists(output[1]):
+                    os.remove(output[1])
+    history.flush()
+    return duplicates
 
 
 def per_format_save_params(image_format: str, save_params: Dict[str, Any]):
@@ -615,20 +1886,47 @@ def main():
         'unmasked': "Only process unmasked images (incompatible with --all)",
         'output-size': (
             "Set the width and height of the output images to this size, note that no input images"
-            " half this size or smaller will be considered."),
+            " half this size or smaller will be considered. A comma-separated list of sizes makes"
+            " every size at once, each in a subdirectory of --output-dir named for the size."),
         'keep': "Keep existing images",
         'transparent': "Make PNG output transparent if the scaled image does not fit in the target dimensions fully",
         'output-dir': "Where to store results",
         'quality': "A value less than 1 that indicates the minimum fraction of the --output-size images to keep",
         'srgb-color-profile': "The path to an ICC color profile for sRGB to convert CMYK images",
         'cmyk-color-profile': "The path to the default ICC profile for CMYK files that have none",
-        'image_dirs': "The image directories to read, includes all subdirs",
+        'image_dirs': (
+            "The image directories to read, includes all subdirs (or with --merge-shards, the"
+            " shard hash files to merge)"),
         'save-params': (
             "A comma-separated string of name=value pairs to pass to the image save formatter"
             " see https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html"),
         'save-format': "The image format (extension) to save as",
         'find-duplicates': "Do not run the conversion at all, just identify duplicates",
         'verbose': "Turn on verbose output",
+        'jobs': "Number of worker processes used to mask, scale and write images",
+        'write-buffer': (
+            "Megabytes of finished images that may be queued to be written in the background"
+            " while the next image is processed, 0 to write each image before moving on"),
+        'header-cache': (
+            f"Save the image header information read from each input directory (in"
+            f" {HeaderCache.cache_name}, written into that directory) for use by later runs"),
+        'incremental': (
+            f"Keep a manifest of what was made from what (in {RunManifest.manifest_name} in the"
+            f" output directory) and only make the outputs whose sources or settings changed"),
+        'timings': "Time each stage of processing and print a breakdown at the end",
+        'timings-json': "Time each stage of processing and save the totals to this JSON file",
+        'shard': (
+            "Only process the Kth of every N image directories, and save the hashes of the images"
+            " kept (including those already in a --hash-index) to a file in the output directory"
+            " for --merge-shards"),
+        'merge-shards': (
+            "Merge the hash files of every --shard of a run and list the outputs that would have been"
+            " duplicates had it been one run"),
+        'remove-duplicates': "With --merge-shards, remove the duplicate outputs found",
+        'hash-index': "A file that keeps the duplicate-detection hashes of every image seen, across runs",
+        'duplicate-distance': (
+            "The number of the 100 cells of the duplicate-detection hash that may differ for"
+            " two images to still be considered duplicates"),
     }
 
     def param_arg(short_flag: str, flag: str, *args, **kwargs):
@@ -641,17 +1939,28 @@ def main():
 
     state_arg('-a', '--all')
     param_arg('-f', '--save-format', default='png')
+    param_arg('-j', '--jobs', metavar='N', type=int, default=1)
+    state_arg('-i', '--incremental')
     state_arg('-k', '--keep')
     param_arg('-o', '--output-dir', metavar='PATH', default=DEFAULT_OUTDIR, type=pathlib.Path)
     param_arg('-q', '--quality', metavar='VALUE', default=DEFAULT_QUALITY, type=float)
-    param_arg('-s', '--output-size', type=int, default=DEFAULT_SIZE)
+    param_arg('-s', '--output-size', type=parse_sizes, default=DEFAULT_SIZE)
     state_arg('-t', '--transparent')
+    state_arg('-T', '--timings')
     state_arg('-u', '--unmasked')
     state_arg('-v', '--verbose')
+    param_arg('-x', '--shard', metavar='K/N', type=parse_shard)
+    param_arg('-w', '--write-buffer', metavar='MB', type=float, default=DEFAULT_WRITE_BUFFER / 2**20)
     param_arg('-C', '--cmyk-color-profile', metavar='ICC_FILE', type=pathlib.Path)
+    param_arg('-D', '--duplicate-distance', metavar='CELLS', type=int, default=0)
     state_arg('-F', '--find-duplicates')
+    state_arg('-H', '--header-cache')
+    param_arg('-I', '--hash-index', metavar='FILE', type=pathlib.Path)
+    param_arg('-J', '--timings-json', metavar='FILE', type=pathlib.Path)
+    state_arg('-M', '--merge-shards')
     param_arg('-S', '--srgb-color-profile', metavar='ICC_FILE', type=pathlib.Path)
     param_arg('-P', '--save-params', metavar='VALUES')
+    state_arg('-R', '--remove-duplicates')
 
     parser.add_argument(
         'image_dirs',
@@ -674,34 +1983,62 @@ def main():
     if options.transparent and options.save_format.lower() != 'png':
         raise RuntimeError(f"--transparent only supported for 'png' images")
 
+    if options.jobs < 1:
+        raise RuntimeError(f"--jobs must be at least 1")
+
     if options.cmyk_color_profile and not options.cmyk_color_profile.exists():
         raise RuntimeError(f"CMYK color profile file does not exist: {options.cmyk_color_profile}")
     if options.srgb_color_profile and not options.srgb_color_profile.exists():
         raise RuntimeError(f"sRGB color profile file does not exist: {options.srgb_color_profile}")
 
-    history = FuzzyImageRecall()
+    if not 0 <= options.duplicate_distance < 100:
+        raise RuntimeError(f"--duplicate-distance must be between 0 and 99")
+
+    history = FuzzyImageRecall(index_path=options.hash_index, threshold=options.duplicate_distance)
+    timer = StageTimer() if options.timings or options.timings_json else None
+
+    if options.merge_shards:
+        for outfile in merge_shards(options.image_dirs, history, remove=options.remove_duplicates):
+            print(f"{'Removed' if options.remove_duplicates else 'Duplicate'}: {outfile}")
+        history.close()
+        return
+
+    image_dirs = [img_dir.absolute() for img_dir in options.image_dirs]
+    hashes = process_img_dirs(
+        image_dirs,
+        history,
+        shard=options.shard,
+        output_size=options.output_size,
+        minimum_quality=options.quality,
+        outdir=options.output_dir,
+        all_images=(options.unmasked or options.all),
+        unmasked=options.unmasked,
+        keep=options.keep,
+        trans_background=options.transparent,
+        image_extension=save_format,
+        save_params=save_params,
+        find_duplicates=options.find_duplicates,
+        srgb_profile=options.srgb_color_profile,
+        cmyk_profile=options.cmyk_color_profile,
+        verbose=options.verbose,
+        jobs=options.jobs,
+        header_cache=options.header_cache,
+        write_buffer=int(options.write_buffer * 2**20),
+        incremental=options.incremental,
+        timer=timer,
+    )
+    history.close()
 
-    for img_dir in options.image_dirs:
-        img_dir = img_dir.absolute()
-        if options.verbose:
-            print(f"Processing from {img_dir}")
-        process_img_dir(
-            img_dir,
-            output_size=options.output_size,
-            minimum_quality=options.quality,
-            outdir=options.output_dir,
-            all_images=(options.unmasked or options.all),
-            unmasked=options.unmasked,
-            keep=options.keep,
-            trans_background=options.transparent,
-            image_extension=save_format,
-            save_params=save_params,
-            history=history,
-            find_duplicates=options.find_duplicates,
-            srgb_profile=options.srgb_color_profile,
-            cmyk_profile=options.cmyk_color_profile,
-            verbose=options.verbose,
-        )
+    if options.shard:
+        shard_file = options.output_dir / f".process-art-shard-{options.shard[0]}-of-{options.shard[1]}.json"
+        write_shard_hashes(shard_file, options.shard, image_dirs, hashes)
+        print(f"Shard hashes saved to {shard_file}")
+
+    if options.timings:
+        print()
+        timer.summarize()
+    if options.timings_json:
+        options.timings_json.write_text(json.dumps(timer.as_dict(), indent=2))
 
 
 @pytest.mark.parametrize(
@@ -755,6 +2092,21 @@ def test_guess_border(image: Image, expected: Union[int, Tuple[int, int, int]],
     assert guess_border(image) == expected, f"Expect return value of {expected!r} for {what_is}"
 
 
+@pytest.mark.parametrize(
+    'corners, expected',
+    [
+        ([0, 0, 0, 0], 0),
+        ([0, 0, 255, 10], 0),
+        ([0, 255, 0, 255], 255),
+        ([(10, 255), (10, 255), (0, 0), (20, 255)], (10, 255)),
+        ([(1, 2, 3, 255), (9, 9, 9, 255), (1, 2, 3, 255), (9, 9, 9, 255)], (9, 9, 9, 255)),
+    ]
+)
+def test_vote_border(corners, expected):
+    """The most common corner wins, ties go to the lightest, in any mode"""
+    assert vote_border(iter(corners)) == expected
+
+
 def make_test_color_image(mode: str):
     """Used for testing color image detection"""
     image = make_test_grayscale_image('RGB')
@@ -793,5 +2145,556 @@ def test_is_color_check(image, is_color, description):
     assert ImageInfo.is_color(image) is is_color, f"Expect is_color={is_color!r} for {description}"
 
 
+@pytest.mark.parametrize('mode', ('RGB', 'RGBA', 'CMYK'))
+def test_is_color_many_colors(mode: str):
+    """Images with more than 256 colors (every photo) are checked like any other"""
+    gradient = Image.linear_gradient('L')
+    image = Image.merge('RGB', [gradient, Image.radial_gradient('L'), gradient.transpose(Image.Transpose.ROTATE_90)])
+    assert len(image.getcolors(maxcolors=2**16)) > 256, "Expect the test image to have more than 256 colors"
+    assert ImageInfo.is_color(image.convert(mode)), "Expect an image with many colors to be color"
+    assert not ImageInfo.is_color(gradient.convert(mode)), "Expect every shade of gray not to be color"
+
+
+def make_test_image_dir(img_dir: pathlib.Path):
+    """Used for testing, write a small directory of numbered images the way pdfimages would"""
+    def color_image(size, color):
+        image = Image.new('RGB', size, (255, 255, 255))
+        ImageDraw.Draw(image).rectangle((4, 4, size[0] - 5, size[1] - 5), fill=color)
+        return image
+
+    def mask(size):
+        image = Image.new('L', size, 0)
+        ImageDraw.Draw(image).ellipse((2, 2, size[0] - 3, size[1] - 3), fill=255)
+        return image
+
+    images = [
+        color_image((64, 48), (200, 30, 30)), mask((64, 48)),
+        color_image((40, 64), (30, 200, 30)),
+        color_image((64, 48), (200, 30, 30)), mask((64, 48)),  # duplicate of the first pair
+        color_image((12, 12), (30, 30, 200)),  # too small
+        color_image((64, 64), (30, 30, 200)),
+        color_image((48, 64), (120, 30, 200)), mask((48, 64)),
+    ]
+    for num, image in enumerate(images, start=1):
+        image.save(img_dir / f"img-{num}.png")
+    (img_dir / "img-100.params").write_text("unsupported")
+
+
+@pytest.mark.parametrize('all_images', (False, True))
+def test_process_img_dir_jobs(tmp_path: pathlib.Path, all_images: bool):
+    """The --jobs process pool and background writes must produce the same output and counts as a serial run"""
+    img_dir = tmp_path / "images"
+    img_dir.mkdir()
+    make_test_image_dir(img_dir)
+    results = []
+    for jobs, write_buffer in ((1, 0), (1, DEFAULT_WRITE_BUFFER), (2, 0), (2, DEFAULT_WRITE_BUFFER)):
+        outdir = tmp_path / f"out-{jobs}-{write_buffer}"
+        outdir.mkdir()
+        stats = process_img_dir(
+            img_dir, outdir=outdir, output_size=32, all_images=all_images, jobs=jobs, write_buffer=write_buffer)
+        outputs = {f.name: f.read_bytes() for f in outdir.iterdir()}
+        results.append((stats, outputs))
+    assert results[0][1], "Expect the serial run to write some images"
+    assert HeaderCache.cache_name not in {f.name for f in img_dir.iterdir()}, "Expect nothing written to the input"
+    for result in results[1:]:
+        assert result == results[0], "Expect identical counts and files from every run"
+
+
+def test_process_img_dir_jobs_decode_once(tmp_path: pathlib.Path):
+    """The --jobs workers decode nothing that the parent already had to, to pair it"""
+    img_dir = tmp_path / "images"
+    img_dir.mkdir()
+    make_test_image_dir(img_dir)
+    decodes = []
+    for jobs in (1, 2):
+        timer = StageTimer()
+        process_img_dir(img_dir, outdir=tmp_path, output_size=32, all_images=True, jobs=jobs, timer=timer)
+        decodes.append(timer.as_dict()['stages']['decode']['calls'])
+    assert decodes[1] == decodes[0], "Expect as many decodes as a serial run"
+
+
+def test_image_writer_buffer(tmp_path: pathlib.Path):
+    """Queued writes never hold more than the buffer, unless a single image is bigger"""
+    image = Image.new('RGB', (64, 64))
+    cost = ImageWriter.cost(image)
+    writer = ImageWriter(max_bytes=cost * 2, threads=4)
+    queued = []
+    original_write = writer._write
+
+    def watched_write(*args):
+        queued.append(writer.queued)
+        return original_write(*args)
+
+    writer._write = watched_write
+    writes = [writer.write(image, tmp_path / f"{n}.png") for n in range(10)]
+    writes.append(writer.write(Image.new('RGB', (256, 256)), tmp_path / "big.png"))
+    writer.close()
+    assert all(write.result() is None for write in writes), "Expect every write to succeed"
+    assert len(list(tmp_path.iterdir())) == 11, "Expect every image to be written"
+    assert max(queued[:10]) <= cost * 2, "Expect the buffer limit to be respected"
+
+
+def test_process_img_dir_write_errors(tmp_path: pathlib.Path):
+    """An image that fails to be written in the background counts as failed, and the run goes on"""
+    img_dir = tmp_path / "images"
+    img_dir.mkdir()
+    make_test_image_dir(img_dir)
+    outdir = tmp_path / "out"
+    outdir.mkdir()
+    stats = process_img_dir(img_dir, outdir=outdir, output_size=32, all_images=True, image_extension='nosuch')
+    assert stats.get('failed') and 'normal' not in stats, "Expect every unsaveable image to fail"
+
+
+def test_fuzzy_image_recall_index(tmp_path: pathlib.Path):
+    """Hashes persisted to the index are known to the next run, but an owner never duplicates itself"""
+    index_path = tmp_path / "index.sqlite"
+    source = tmp_path / "source.png"
+    image = make_test_color_image('RGB')
+    image.save(source)
+    history = FuzzyImageRecall(index_path=index_path)
+    key = history.image_key(image, [source])
+    assert history.parse_repr(history.key_repr(key)) == key, "Expect parse_repr to invert key_repr"
+    history.add_key(key, owner="first.png")
+    history.close()
+
+    history = FuzzyImageRecall(index_path=index_path)
+    assert history.cached_key([source]) == key, "Expect the hash of an unchanged source to be remembered"
+    assert history.contains_key(key, owner="second.png"), "Expect a persisted hash to be found"
+    assert not history.contains_key(key, owner="first.png"), "Expect an image not to duplicate itself"
+    history.close()
+
+    with contextlib.closing(sqlite3.connect(index_path)) as index:
+        index.execute("PRAGMA user_version = 0")
+    history = FuzzyImageRecall(index_path=index_path)
+    assert history.cached_key([source]) is None, "Expect hashes made another way to be forgotten"
+    assert not history.contains_key(key), "Expect hashes made another way to be forgotten"
+    history.close()
+
+
+@pytest.mark.parametrize('threshold', (1, 2, 5))
+def test_hamming_index(threshold: int):
+    """Keys within the threshold are found, keys beyond it are not"""
+    index = HammingIndex(threshold)
+    stored = tuple(n % 16 for n in range(100))
+    index.add(stored)
+    index.add(tuple(15 - n for n in stored))
+    for differing in range(threshold + 2):
+        # Spread the differences out so that they land in different blocks
+        query = tuple((v + 1) % 16 if n % 17 == 0 and n // 17 < differing else v for n, v in enumerate(stored))
+        assert (stored in index.near(query)) is (differing <= threshold), \
+            f"Expect a key {differing} cells away to be found only within threshold {threshold}"
+
+
+def reference_autocrop(image: Image):
+    """Used for testing, the original column-by-column version of `FuzzyImageRecall._autocrop`"""
+    upper_left_x = 0
+    upper_left_y = 0
+    lower_right_x = image.width - 1
+    lower_right_y = image.height - 1
+    white = white_pixel(image.mode)
+    np_image = numpy.asarray(image)
+
+    def first_column(from_end=False):
+        cols = range(upper_left_x, lower_right_x)
+        if from_end:
+            cols = reversed(cols)
+        for x in cols:
+            if numpy.any(np_image[:, x] != white):
+                return x
+        return None
+
+    def first_row(from_end=False):
+        rows = range(upper_left_y, lower_right_y)
+        if from_end:
+            rows = reversed(rows)
+        for y in rows:
+            if numpy.any(np_image[y, :] != white):
+                return y
+        return None
+
+    upper_left_x = first_column()
+    if upper_left_x is None:
+        return image
+    lower_right_x = first_column(from_end=True)
+    upper_left_y = first_row()
+    if upper_left_y is None:
+        return image
+    lower_right_y = first_row(from_end=True)
+    return image.crop((upper_left_x, upper_left_y, lower_right_x+1, lower_right_y+1))
+
+
+@pytest.mark.parametrize('mode', ('1', 'L', 'RGB', 'RGBA', 'CMYK'))
+@pytest.mark.parametrize('size', ((1, 1), (1, 5), (5, 1), (2, 2), (7, 4), (16, 16)))
+def test_autocrop_matches_reference(mode: str, size: Tuple[int, int]):
+    """The vectorized autocrop must crop exactly as the column-by-column scan did"""
+    rng = numpy.random.default_rng(sum(size))
+    black = black_pixel(mode)
+    for trial in range(20):
+        image = Image.new(mode, size, white_pixel(mode))
+        for _ in range(trial % 4):
+            image.putpixel((int(rng.integers(size[0])), int(rng.integers(size[1]))), black)
+        expected = reference_autocrop(image)
+        cropped = FuzzyImageRecall._autocrop(image)
+        assert cropped.size == expected.size, f"Expect the same crop as the reference for {size} {mode}"
+        assert cropped.tobytes() == expected.tobytes(), f"Expect the same pixels as the reference for {size} {mode}"
+
+
+def test_image_info_cache():
+    """Derived values are computed once, and the small ones outlive the pixel data"""
+    info = ImageInfo(file_path="test.png", image=make_test_color_image('RGB'))
+    history = FuzzyImageRecall()
+    assert info.color is True, "Expect the test image to be color"
+    key = info.fuzzy_key(history)
+    assert info.thumbnail(16) is info.thumbnail(16), "Expect the thumbnail to be computed once"
+    info.release()
+    assert info.image is None, "Expect release to drop the pixel data"
+    assert info.size == (256, 256), "Expect the size to be kept after release"
+    assert info.color is True and info.fuzzy_key(history) == key, "Expect cached values to be kept after release"
+    assert ('thumbnail', 16) not in info.cache, "Expect thumbnails to be dropped on release"
+
+
+def test_image_info_composite():
+    """A masked image is hashed from a composite no larger than `ImageInfo.composite_size`"""
+    image = ImageInfo(file_path="test.png", image=make_test_color_image('RGB').resize((2048, 1024)))
+    mask = ImageInfo(file_path="mask.png", image=Image.new('L', image.size, 255), is_mask=True)
+    composite = image.masked(mask, mask_background('RGB')).composite()
+    assert composite.size == (ImageInfo.composite_size, ImageInfo.composite_size // 2), "Expect a scaled composite"
+    small = ImageInfo(file_path="small.png", image=image.thumbnail(100))
+    small_mask = ImageInfo(file_path="mask.png", image=mask.thumbnail(100), is_mask=True)
+    assert small.masked(small_mask, mask_background('RGB')).composite().size == (100, 50), \
+        "Expect a small image not to be scaled up"
+
+
+def test_image_info_key_without_decode(tmp_path: pathlib.Path):
+    """A hash already in the index is used without decoding the image"""
+    path = tmp_path / "image.png"
+    make_test_color_image('RGB').save(path)
+    history = FuzzyImageRecall(index_path=tmp_path / "index.sqlite")
+    key = ImageInfo.get_image_info(path).fuzzy_key(history, [path])
+    info = ImageInfo.get_image_info(path)
+    assert info.fuzzy_key(history, [path]) == key, "Expect the indexed hash"
+    assert info.image.tile, "Expect the image not to have been decoded"
+    history.close()
+
+
+def test_image_info_draft(tmp_path: pathlib.Path):
+    """A JPEG can be decoded at a reduced scale that still covers the output size"""
+    path = tmp_path / "large.jpg"
+    make_test_color_image('RGB').resize((1024, 768)).save(path)
+    info = ImageInfo.get_image_info(path)
+    assert info.draft(100), "Expect a large JPEG to be drafted"
+    assert info.size == (1024, 768), "Expect size to stay that of the source"
+    assert min(info.image.size) >= 100 and info.image.width < 1024, "Expect a reduced decode covering the size"
+    assert info.thumbnail(100).size == (100, 75), "Expect the thumbnail to be the same size as from a full decode"
+    assert info.fuzzy_key(FuzzyImageRecall()) == ImageInfo.get_image_info(path).fuzzy_key(FuzzyImageRecall()), \
+        "Expect the same hash as from a full decode"
+
+    info = ImageInfo.get_image_info(path)
+    info.image.load()
+    assert not info.draft(100), "Expect no draft once the image has been decoded"
+
+
+@pytest.mark.parametrize('size', (128, 256, 512))
+def test_fuzzy_key_drafted(tmp_path: pathlib.Path, size: int):
+    """A drafted decode of a JPEG gets the same fuzzy hash as a full decode of it"""
+    path = tmp_path / "art.jpg"
+    image = Image.new('RGB', (2000, 1500), (240, 240, 240))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, 0, 999, 749), fill=(200, 30, 30))
+    draw.rectangle((1000, 750, 1999, 1499), fill=(30, 30, 200))
+    draw.ellipse((600, 400, 1400, 1100), fill=(30, 160, 30))
+    image.save(path, quality=90)
+    drafted = ImageInfo.get_image_info(path)
+    assert drafted.draft(size), "Expect a large JPEG to be drafted"
+    assert drafted.fuzzy_key(FuzzyImageRecall()) == ImageInfo.get_image_info(path).fuzzy_key(FuzzyImageRecall()), \
+        "Expect the same hash as from a full decode"
+
+
+def test_iter_image_files(tmp_path: pathlib.Path):
+    """Streaming the tree a directory at a time must give the same order as sorting every path"""
+    for name in (
+            "a-2.png", "a-10.png", "a-1.png", "a", "b", "a-3.x/c-1.png", "a-3.x/c-12.png",
+            "a/d-100.png", "a/d-20.png", "a/sub/e.png", "b/f.png", ".hidden.png", ".git/g.png"):
+        path = tmp_path / name
+        if "." in path.name:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(name)
+        else:
+            path.mkdir(parents=True, exist_ok=True)
+    (tmp_path / "noext").write_text("noext")
+    globbed = (pathlib.Path(f) for f in tmp_path.glob(os.path.join('**', '*.*')) if os.path.isfile(f))
+    assert list(iter_image_files(tmp_path)) == sorted(globbed, key=get_filename_key), \
+        "Expect the same files in the same order as a sorted recursive glob"
+
+
+def test_header_cache(tmp_path: pathlib.Path, monkeypatch):
+    """Headers are read from the start of the file, and re-runs use the saved cache"""
+    make_test_color_image('RGB').save(tmp_path / "image.png")
+    (tmp_path / "text.txt").write_text("not an image")
+    cache = HeaderCache(tmp_path, persist=True)
+    header = cache.get(tmp_path / "image.png")
+    assert (header['format'], header['width'], header['height']) == ('PNG', 256, 256), "Expect PNG header info"
+    assert 'error' in cache.get(tmp_path / "text.txt"), "Expect a non-image to be recorded as an error"
+    cache.save()
+
+    def no_sniffing(img_path):
+        raise AssertionError(f"Expect no header reads for unchanged {img_path}")
+
+    monkeypatch.setattr(HeaderCache, 'sniff', no_sniffing)
+    cache = HeaderCache(tmp_path, persist=True)
+    assert cache.get(tmp_path / "image.png")['width'] == 256, "Expect the saved header info"
+    assert 'error' in cache.get(tmp_path / "text.txt"), "Expect the saved error"
+    assert HeaderCache.cache_name not in {f.name for f in iter_image_files(tmp_path)}, \
+        "Expect the cache file to never be processed as an image"
+
+
+@pytest.mark.parametrize('size', ((64, 48), (48, 64), (64, 64)))
+@pytest.mark.parametrize('trans_background', (False, True))
+def test_composite_to_square(size: Tuple[int, int], trans_background: bool):
+    """Compositing after scaling matches compositing before, where the image under the mask is uniform"""
+    image = Image.new('RGB', size, (200, 30, 30))
+    mask = Image.new('L', size, 0)
+    ImageDraw.Draw(mask).ellipse((2, 2, size[0] - 3, size[1] - 3), fill=255)
+    background = mask_background('RGB', trans_background)
+    expected = pad_to_square(
+        ImageOps.contain(mask_image(image, mask, background), size=(32, 32)), 32, trans_background)
+    fused = composite_to_square(image, mask, background, 32, trans_background)
+    assert (fused.mode, fused.size) == (expected.mode, expected.size), "Expect the same mode and size"
+    expected_pixels = numpy.asarray(expected).astype(float)
+    fused_pixels = numpy.asarray(fused).astype(float)
+    if trans_background:
+        # Compare premultiplied colors, the color of a (nearly) transparent pixel doesn't matter
+        expected_pixels[..., :3] *= expected_pixels[..., 3:] / 255
+        fused_pixels[..., :3] *= fused_pixels[..., 3:] / 255
+    # Resampling rings a little around the mask edge, and is clamped differently in each order
+    assert numpy.abs(expected_pixels - fused_pixels).max() <= 16, "Expect the same pixels, up to resampling"
+    assert numpy.abs(expected_pixels - fused_pixels).mean() <= 1, "Expect the same pixels, up to resampling"
+
+
+def test_cmyk_transform_cache():
+    """Transforms are built once per distinct embedded profile"""
+    profile_data = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+    transform = cmyk_transform('RGB', profile_data, None, None)
+    assert cmyk_transform('RGB', bytes(bytearray(profile_data)), None, None) is transform, \
+        "Expect an equal profile to reuse the transform"
+    image = make_test_color_image('RGB')
+    image.info['icc_profile'] = profile_data
+    info = ImageInfo(file_path="test.png", image=image)
+    info.from_cmyk_to_rgb()
+    assert info.image.mode == 'RGB' and info.color, "Expect the transformed image to stay RGB color"
+
+
+@pytest.mark.parametrize('jobs', (1, 2))
+def test_process_img_dir_incremental(tmp_path: pathlib.Path, monkeypatch, capsys, jobs: int):
+    """A re-run decodes nothing that is unchanged, and remakes only what changed"""
+    img_dir = tmp_path / "images"
+    img_dir.mkdir()
+    make_test_image_dir(img_dir)
+    outdir = tmp_path / "out"
+    outdir.mkdir()
+    args = dict(outdir=outdir, output_size=32, all_images=True, incremental=True, jobs=jobs)
+    first = process_img_dir(img_dir, **args)
+    outputs = {f.name: f.stat().st_mtime_ns for f in outdir.glob("*.png")}
+
+    with monkeypatch.context() as patch:
+        def no_decoding(*args):
+            raise AssertionError("Expect nothing to be decoded")
+        patch.setattr(Image.Image, 'load', no_decoding)
+        second = process_img_dir(img_dir, **dict(args, jobs=1))
+    assert second['unchanged'] == first['normal'], "Expect every written image to be unchanged"
+    assert second['duplicate'] == first['duplicate'], "Expect the same duplicates"
+
+    # Touching a file alone is not a change, but new content is
+    os.utime(img_dir / "img-1.png", ns=(0, 0))
+    Image.new('RGB', (40, 64), (200, 200, 30)).save(img_dir / "img-3.png")
+    third = process_img_dir(img_dir, **args)
+    assert third['normal'] == 1 and third['unchanged'] == first['normal'] - 1, "Expect one image to be remade"
+    remade = [f.name for f in outdir.glob("*.png") if f.stat().st_mtime_ns != outputs[f.name]]
+    assert remade == ["img-3.png"], "Expect only the changed image to be written again"
+
+    # Now a copy of a later image, which a re-run has to find that one to be a duplicate of
+    (img_dir / "img-3.png").write_bytes((img_dir / "img-7.png").read_bytes())
+    serial = tmp_path / "serial"
+    serial.mkdir()
+    for path in outdir.iterdir():
+        (serial / path.name).write_bytes(path.read_bytes())
+
+    def statuses(**run_args):
+        capsys.readouterr()
+        process_img_dir(img_dir, **dict(args, verbose=True, **run_args))
+        lines = [line.split() for line in capsys.readouterr().out.splitlines() if "image processing" in line]
+        return [(words[2].rstrip(","), pathlib.Path(words[-1]).name) for words in lines]
+    expected = statuses(outdir=serial, jobs=1)
+    assert ("duplicate", "img-7.png") in expected, "Expect the later image to be the duplicate"
+    assert statuses(jobs=2) == expected, "Expect the same statuses in the same order with jobs"
+
+    fourth = process_img_dir(img_dir, **dict(args, output_size=24))
+    assert 'unchanged' not in fourth, "Expect new settings to remake everything"
+
+
+def test_process_img_dir_incremental_counts(tmp_path: pathlib.Path, monkeypatch, capsys):
+    """A re-run counts CMYK images, and the total, just as the run that made the outputs did"""
+    img_dir = tmp_path / "images"
+    img_dir.mkdir()
+    make_test_image_dir(img_dir)
+    for num in (1, 3, 8):
+        path = img_dir / f"img-{num}.png"
+        Image.open(path).convert('CMYK').save(path.with_suffix(".tif"))
+        path.unlink()
+    # There's no CMYK profile to hand, so convert naively
+    monkeypatch.setattr(ImageInfo, 'from_cmyk_to_rgb', lambda self, *args: self.to_rgb())
+
+    def run():
+        stats = process_img_dir(img_dir, outdir=tmp_path, output_size=32, all_images=True, incremental=True)
+        total = [line for line in capsys.readouterr().out.splitlines() if line.startswith("Total")]
+        return stats, total
+
+    first, first_total = run()
+    second, second_total = run()
+    assert second['unchanged'] == first['normal'], "Expect every image to be unchanged"
+    assert second['cmyk'] == first['cmyk'] == 3, "Expect the same CMYK images to be counted"
+    assert second_total == first_total, "Expect the same total"
+
+
+@pytest.mark.parametrize('jobs, write_buffer', ((1, 0), (1, DEFAULT_WRITE_BUFFER), (2, 0)))
+def test_process_img_dir_timer(tmp_path: pathlib.Path, jobs: int, write_buffer: int):
+    """Every stage is timed, in workers and writer threads too"""
+    img_dir = tmp_path / "images"
+    img_dir.mkdir()
+    make_test_image_dir(img_dir)
+    timer = StageTimer()
+    stats = process_img_dir(
+        img_dir, outdir=tmp_path, output_size=32, all_images=True, jobs=jobs, write_buffer=write_buffer, timer=timer)
+    stages = timer.as_dict()['stages']
+    assert {'decode', 'color', 'hash', 'render', 'encode'} <= set(stages), "Expect the main stages to be timed"
+    written = sum(f.stat().st_size for f in tmp_path.glob("*.png"))
+    if jobs == 1:
+        assert stages['encode']['calls'] == stats['normal'], "Expect one encode per image written"
+        assert stages['encode']['bytes'] == written, "Expect the encoded bytes to be counted"
+    else:
+        # Workers also encode the duplicates that the parent then throws away
+        assert stages['write']['calls'] == stats['normal'], "Expect one write per image written"
+        assert stages['write']['bytes'] == written, "Expect the written bytes to be counted"
+    assert stages['render']['pixels'] == stages['render']['calls'] * 32 * 32, "Expect the rendered pixels to be counted"
+
+
+@pytest.mark.parametrize('mode', ('RGB', 'RGBA', 'P', 'CMYK'))
+def test_is_color_sampled(mode: str):
+    """A color pixel that the sample steps over is still found, without any false positives"""
+    def convert(image: Image):
+        # Without an adaptive palette, even gray comes out dithered
+        return image.convert(mode, palette=Image.Palette.ADAPTIVE)
+
+    image = Image.new('RGB', (1001, 999), (128, 128, 128))
+    assert not ImageInfo.is_color(convert(image)), "Expect a gray image not to be color"
+    image.putpixel((1000, 998), (200, 30, 30))
+    assert ImageInfo.is_color(convert(image)), "Expect one stray color pixel to make it color"
+    image.paste((30, 200, 30), (0, 0, 1001, 500))
+    assert ImageInfo.is_color(convert(image)), "Expect the sample to find color"
+
+
+@pytest.mark.parametrize('mode', ('L', 'LA', 'RGB'))
+def test_pad_to_square_gray(mode: str):
+    """Grayscale images are padded with a gray border"""
+    image = Image.new(mode, (20, 10), white_pixel(mode))
+    padded = pad_to_square(image, 20)
+    assert padded.mode == 'RGB' and padded.getpixel((0, 19)) == (255, 255, 255), "Expect a white RGB border"
+
+
+@pytest.mark.parametrize('runs', (1, 2))
+@pytest.mark.parametrize('output_size', (32, [16, 32]))
+def test_shard_and_merge(tmp_path: pathlib.Path, runs: int, output_size: Union[int, List[int]]):
+    """
+    Shards merged with duplicates removed leave the same outputs as one run over every
+    directory, at every size, even when each shard was run again with its own hash index
+    """
+    image_dirs = [tmp_path / f"images-{n}" for n in range(3)]
+    for img_dir in image_dirs:
+        img_dir.mkdir()
+    make_test_image_dir(image_dirs[0])
+    # A later directory, in another shard, that uses the first image and mask again
+    for num in (1, 2):
+        (image_dirs[1] / f"again-{num}.png").write_bytes((image_dirs[0] / f"img-{num}.png").read_bytes())
+    make_test_image_dir(image_dirs[2])
+    for path in image_dirs[2].iterdir():
+        path.rename(path.with_name(f"more-{path.name}"))
+    args = dict(output_size=output_size, all_images=True)
+
+    single = tmp_path / "single"
+    single.mkdir()
+    process_img_dirs(image_dirs, FuzzyImageRecall(), outdir=single, **args)
+
+    sharded = tmp_path / "sharded"
+    sharded.mkdir()
+    shard_files = []
+    for k in (1, 2):
+        for _ in range(runs):
+            history = FuzzyImageRecall(index_path=tmp_path / f"index-{k}.sqlite")
+            hashes = process_img_dirs(image_dirs, history, shard=(k, 2), outdir=sharded, **args)
+            history.flush()
+        shard_files.append(tmp_path / f"shard-{k}.json")
+        write_shard_hashes(shard_files[-1], (k, 2), image_dirs, hashes)
+    duplicates = merge_shards(shard_files, FuzzyImageRecall(), remove=True)
+
+    sizes = [output_size] if isinstance(output_size, int) else output_size
+    assert [pathlib.Path(d).name for d in duplicates] == ["again-1.png"] * len(sizes), \
+        "Expect the images that only another shard had seen before to be found at each size"
+    assert sorted(f.relative_to(sharded) for f in sharded.rglob("*.png")) == \
+           sorted(f.relative_to(single) for f in single.rglob("*.png")), "Expect the same outputs as one run"
+
+
+@pytest.mark.parametrize('jobs', (1, 2))
+def test_process_img_dir_sizes(tmp_path: pathlib.Path, jobs: int):
+    """A list of sizes makes, in one pass, what a run at each size would have made"""
+    img_dir = tmp_path / "images"
+    img_dir.mkdir()
+    make_test_image_dir(img_dir)
+    outdir = tmp_path / "sizes"
+    outdir.mkdir()
+    process_img_dir(img_dir, outdir=outdir, output_size=[16, 32], all_images=True, jobs=jobs)
+    for size in (16, 32):
+        single = tmp_path / f"single-{size}"
+        single.mkdir()
+        process_img_dir(img_dir, outdir=single, output_size=size, all_images=True)
+        outputs = sorted((outdir / str(size)).iterdir())
+        assert [f.name for f in outputs] == sorted(f.name for f in single.iterdir()), \
+            f"Expect the same images at size {size}"
+        assert all(Image.open(f).size == (size, size) for f in outputs), f"Expect every image to be {size} square"
+    assert all((outdir / "32" / f.name).read_bytes() == (tmp_path / "single-32" / f.name).read_bytes()
+               for f in (outdir / "32").iterdir()), "Expect the largest size to be rendered just like a single size"
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_process_img_dir_sizes_duplicates(tmp_path: pathlib.Path, jobs: int):
+    """An image too small for the largest size only makes duplicates of later ones at its own sizes"""
+    img_dir = tmp_path / "images"
+    img_dir.mkdir()
+    for num, size in enumerate([(12, 12), (64, 64), (64, 64)], start=1):
+        image = Image.new('RGB', size, (255, 255, 255))
+        ImageDraw.Draw(image).rectangle((2, 2, size[0] - 3, size[1] - 3), fill=(30, 30, 200))
+        image.save(img_dir / f"img-{num}.png")
+    outdir = tmp_path / "sizes"
+    outdir.mkdir()
+    process_img_dir(img_dir, outdir=outdir, output_size=[16, 32], all_images=True, jobs=jobs)
+    assert sorted(f.name for f in (outdir / "16").iterdir()) == ["img-1.png"], \
+        "Expect the later copies to be duplicates of the small one at its size"
+    assert sorted(f.name for f in (outdir / "32").iterdir()) == ["img-2.png"], \
+        "Expect the first full size copy to be made at the size the small one is too small for"
+
+
+@pytest.mark.parametrize(
+    'corners, trans_background, expected',
+    [
+        ([0, 255, 255, 255], False, ('RGB', (255, 255, 255))),
+        ([(10, 255), (10, 255), (0, 0), (20, 255)], False, ('RGB', (10, 10, 10))),
+        ([(1, 2, 3), (1, 2, 3), (4, 5, 6), (7, 8, 9)], True, ('RGBA', (1, 2, 3, 0))),
+        ([(1, 2, 3, 255)] * 4, False, ('RGB', (1, 2, 3))),
+    ]
+)
+def test_plan_border(corners, trans_background: bool, expected):
+    """Corner pixels in any mode plan an RGB or transparent RGBA border"""
+    assert plan_border(corners, trans_background) == expected
+
+
 if __name__ == '__main__':
     main()
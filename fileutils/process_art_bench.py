@@ -0,0 +1,231 @@
+# Micro-benchmarks for process_art.py. Run from this directory:
+#
+#     python process_art_bench.py
+#
+# or, for the pytest-benchmark suite over synthetic corpora of several sizes:
+#
+#     pytest process_art_bench.py
+#
+# To write a synthetic corpus to a directory, for timing process-art itself:
+#
+#     python process_art_bench.py --corpus DIR --pairs 200
+#
+# CMYK TIFFs are only part of a corpus if given a CMYK ICC profile to embed in them
+# (with -C, or the PROCESS_ART_CMYK_PROFILE environment variable for pytest).
+#
+# This program is distributed under the terms of the MIT License, which you can
+# find here: https://opensource.org/license/mit/ as well as in this repository's root
+# directory.
+
+import argparse
+import os
+import pathlib
+import random
+import shutil
+import timeit
+from typing import Optional
+
+import pytest
+from PIL import Image, ImageDraw
+
+import process_art
+
+
+def bordered_image(size: int, mode: str = 'RGB', inset: float = 0.1):
+    """A white image with a dark rectangle inset from each edge by a fraction of its size"""
+    image = Image.new(mode, (size, size), process_art.white_pixel(mode))
+    inset = int(size * inset)
+    ImageDraw.Draw(image).rectangle(
+        (inset, inset, size - inset, size - inset), fill=process_art.black_pixel(mode))
+    return image
+
+
+def random_art(rng: random.Random, size, mode: str = 'RGB'):
+    """A white page with an assortment of colored shapes, standing in for a piece of art"""
+    image = Image.new('RGB', size, (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    width, height = size
+    for _ in range(rng.randint(3, 12)):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        box = (x0, y0, rng.randint(x0, width), rng.randint(y0, height))
+        fill = tuple(rng.randrange(256) for _ in range(3))
+        (draw.ellipse if rng.random() < 0.5 else draw.rectangle)(box, fill=fill)
+    return image.convert(mode)
+
+
+def random_mask(rng: random.Random, size):
+    """An L mode mask that keeps an ellipse out of the middle of the image"""
+    mask = Image.new('L', size, 0)
+    width, height = size
+    inset = rng.uniform(0.02, 0.2)
+    ImageDraw.Draw(mask).ellipse(
+        (width * inset, height * inset, width * (1 - inset), height * (1 - inset)), fill=255)
+    return mask
+
+
+def make_corpus(
+        img_dir: os.PathLike,
+        pairs: int,
+        seed: int = 0,
+        max_size: int = 1200,
+        cmyk_profile: Optional[os.PathLike] = None,
+):
+    """
+    Write a synthetic corpus of `pairs` entries to `img_dir`, numbered the way
+    pdfimages numbers them: mostly JPEG images each followed by its PNG mask, along
+    with unmasked RGBA and grayscale images, images too small to keep, duplicates of
+    earlier pairs and, if there is a `cmyk_profile` to embed, masked CMYK TIFFs.
+    Returns the number of files written.
+    """
+    rng = random.Random(seed)
+    img_dir = pathlib.Path(img_dir)
+    kinds = ['masked'] * 5 + ['rgba', 'gray', 'tiny', 'duplicate'] + (['cmyk'] if cmyk_profile else [])
+    icc_profile = pathlib.Path(cmyk_profile).read_bytes() if cmyk_profile else None
+    written = []
+    # The index of each entry's first file, and how many files it has
+    entries = []
+
+    def write(image: Image, extension: str, **params):
+        path = img_dir / f"img-{len(written):03d}.{extension}"
+        image.save(path, **params)
+        written.append(path)
+
+    def copy(path: pathlib.Path):
+        target = img_dir / f"img-{len(written):03d}{path.suffix}"
+        shutil.copyfile(path, target)
+        written.append(target)
+
+    for _ in range(pairs):
+        kind = rng.choice(kinds)
+        size = (rng.randint(max_size // 4, max_size), rng.randint(max_size // 4, max_size))
+        start = len(written)
+        if kind == 'duplicate' and entries:
+            # pdfimages writes out the same image again each time the PDF uses it,
+            # byte for byte
+            source, count = rng.choice(entries)
+            for path in written[source:source + count]:
+                copy(path)
+        elif kind == 'masked':
+            write(random_art(rng, size), 'jpg', quality=90)
+            write(random_mask(rng, size), 'png')
+        elif kind == 'cmyk':
+            write(random_art(rng, size, 'CMYK'), 'tif', icc_profile=icc_profile)
+            write(random_mask(rng, size), 'png')
+        elif kind == 'rgba':
+            write(random_art(rng, size, 'RGBA'), 'png')
+        elif kind == 'gray':
+            write(random_art(rng, size, 'L'), 'png')
+        else:
+            write(random_art(rng, (rng.randint(8, 64), rng.randint(8, 64))), 'png')
+        if len(written) > start:
+            entries.append((start, len(written) - start))
+    return len(written)
+
+
+def bench_autocrop(sizes, repeat: int):
+    """Compare the vectorized autocrop against the original column-by-column scan"""
+    print(f"{'size':>6} {'inset':>6} {'reference':>12} {'vectorized':>12} {'speedup':>8}")
+    for size in sizes:
+        # A narrow border favors the old scan, which stops at the first non-white column
+        for inset in (0.1, 0.45):
+            image = bordered_image(size, inset=inset)
+            reference = min(timeit.repeat(
+                lambda: process_art.reference_autocrop(image), number=1, repeat=repeat))
+            vectorized = min(timeit.repeat(
+                lambda: process_art.FuzzyImageRecall._autocrop(image), number=1, repeat=repeat))
+            print(
+                f"{size:>6} {inset:>6} {reference:>11.4f}s {vectorized:>11.4f}s"
+                f" {reference / vectorized:>7.1f}x")
+
+
+def main():
+    """Run the micro-benchmarks"""
+
+    parser = argparse.ArgumentParser('process-art-bench')
+    parser.add_argument(
+        '-s', '--sizes', action='store', default='500,2000,6000',
+        help="Comma-separated image sizes (width and height) to benchmark")
+    parser.add_argument('-r', '--repeat', action='store', type=int, default=3, help="Best of how many runs")
+    parser.add_argument(
+        '-c', '--corpus', action='store', metavar='DIR', type=pathlib.Path,
+        help="Write a synthetic corpus to this directory instead of running the micro-benchmarks")
+    parser.add_argument('-p', '--pairs', action='store', type=int, default=100, help="Entries in the --corpus")
+    parser.add_argument(
+        '-C', '--cmyk-color-profile', action='store', metavar='ICC_FILE', type=pathlib.Path,
+        help="A CMYK ICC profile to embed in CMYK TIFFs, which are left out of the --corpus without one")
+    options = parser.parse_args()
+
+    if options.corpus:
+        options.corpus.mkdir(parents=True, exist_ok=True)
+        count = make_corpus(options.corpus, options.pairs, cmyk_profile=options.cmyk_color_profile)
+        print(f"Wrote {count} files to {options.corpus}")
+        return
+
+    bench_autocrop([int(s) for s in options.sizes.split(",")], options.repeat)
+
+
+CORPUS_SIZES = (10, 40)
+CMYK_PROFILE = os.environ.get('PROCESS_ART_CMYK_PROFILE')
+
+
+@pytest.fixture(scope='module', params=CORPUS_SIZES)
+def corpus(request, tmp_path_factory):
+    """A synthetic corpus of each of the benchmarked sizes"""
+    img_dir = tmp_path_factory.mktemp(f"corpus-{request.param}")
+    make_corpus(img_dir, request.param, max_size=800, cmyk_profile=CMYK_PROFILE)
+    return img_dir
+
+
+@pytest.mark.parametrize('jobs', (1, 2))
+def test_bench_process_img_dir(benchmark, corpus, tmp_path, jobs: int):
+    """End to end, with the header cache off so that every round does the same work"""
+    benchmark.pedantic(
+        process_art.process_img_dir,
+        args=(corpus,),
+        kwargs=dict(outdir=tmp_path, all_images=True, jobs=jobs, header_cache=False),
+        rounds=3)
+
+
+@pytest.fixture(scope='module', params=(500, 2000))
+def art(request):
+    """A piece of synthetic art at each of the benchmarked sizes"""
+    rng = random.Random(request.param)
+    size = (request.param, request.param * 3 // 4)
+    return process_art.ImageInfo(file_path="art.png", image=random_art(rng, size)), random_mask(rng, size)
+
+
+def test_bench_autocrop(benchmark, art):
+    benchmark(process_art.FuzzyImageRecall._autocrop, art[0].image)
+
+
+def test_bench_is_color(benchmark, art):
+    benchmark(process_art.ImageInfo.is_color, art[0].image)
+
+
+def test_bench_fuzzy_hash(benchmark, art):
+    benchmark(process_art.FuzzyImageRecall()._to_tuple, art[0].image)
+
+
+def test_bench_render_masked(benchmark, art):
+    image, mask = art
+    masked = image.masked(process_art.ImageInfo(file_path="mask.png", image=mask), (255, 255, 255))
+    benchmark(process_art.render_square, masked, process_art.DEFAULT_SIZE)
+
+
+def test_bench_render_unmasked(benchmark, art):
+    # A fresh ImageInfo each time, so that the cached thumbnail isn't reused
+    benchmark(lambda: process_art.render_square(
+        process_art.ImageInfo(file_path="art.png", image=art[0].image), process_art.DEFAULT_SIZE))
+
+
+@pytest.mark.skipif(not CMYK_PROFILE, reason="needs PROCESS_ART_CMYK_PROFILE")
+def test_bench_cmyk_to_rgb(benchmark, art):
+    cmyk = art[0].image.convert('CMYK')
+
+    def convert():
+        process_art.ImageInfo(file_path="art.tif", image=cmyk).from_cmyk_to_rgb(cmyk_profile=CMYK_PROFILE)
+    benchmark(convert)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,14 +13,29 @@
 import os
 import sys
 import re
+import time
+import random
+import stat
+import signal
+import threading
+import Queue
+import SocketServer
+import multiprocessing
 from math import log
 from optparse import OptionParser
+import primality
+try:
+    import gmpy2
+except ImportError:
+    gmpy2 = None
 
 global verbose, options, tab
 
 verbose = 0             # How much tracing info
 tab = ''                # Indentation for $verbose mode
 previous = None         # Previous value
+pool = None             # Worker processes for --threads
+best_index = None       # Shared by the workers, see search_stride
 
 # Static primes.
 # In the perl version, these were tucked away at the end of the file after
@@ -54,6 +69,70 @@ static_primes = (
     )
 last_static = static_primes[-1]
 
+# Candidates are sieved by the odd primes below sieve_limit, a window of
+# sieve_window_size candidates at a time (see sieve_window)
+sieve_limit = 65536
+sieve_window_size = 4096
+
+# Return the odd primes below limit, by the sieve of Eratosthenes
+def odd_primes_below(limit):
+    composite = bytearray(limit)
+    primes = []
+    for n in xrange(3, limit, 2):
+        if not composite[n]:
+            primes.append(n)
+            composite[n*n::2*n] = '\x01' * len(xrange(n*n, limit, 2*n))
+    return primes
+
+sieve_primes = odd_primes_below(sieve_limit)
+
+# Sieve the window of candidates start, start+2, ... start+2*(size-1), where
+# start is odd. Returns a bytearray that is non-zero at the index of each
+# candidate with a factor in sieve_primes. The residue of start is taken once
+# per prime, and then every multiple of that prime in the window is marked at
+# once. If strong, candidates p where (p-1)/2 has a factor in sieve_primes or
+# is even are marked too, since they can't be strong primes.
+def sieve_window(start, size, strong=False):
+    composite = bytearray(size)
+    for q in sieve_primes:
+        # start+2i = 0 (mod q) where i = -start/2, and 1/2 = (q+1)/2 (mod q)
+        half = (q+1)>>1
+        i = (-start * half) % q
+        if start + 2*i == q:
+            i += q # q itself is prime
+        if i < size:
+            composite[i::q] = '\x01' * len(xrange(i, size, q))
+        if strong:
+            # (p-1)/2 = 0 (mod q) where p = 1 (mod q)
+            i = ((1 - start) * half) % q
+            while start + 2*i <= 2*q + 1:
+                i += q # (p-1)/2 is 0, or q itself
+            if i < size:
+                composite[i::q] = '\x01' * len(xrange(i, size, q))
+    if strong:
+        # (p-1)/2 is even where p = 1 (mod 4)
+        i = ((1 - start) % 4) >> 1
+        while start + 2*i <= 5:
+            i += 2 # (p-1)/2 is 0, or 2 itself
+        composite[i::2] = '\x01' * len(xrange(i, size, 2))
+    return composite
+
+# Generate the index i of each candidate initial_p+2i, counting up from 0,
+# that survives the sieve. For search_stride, only every nth index, starting
+# with the wth, is generated, and only those below the shared best.value.
+def sieved_indices(initial_p, w=0, n=1, best=None, strong=False):
+    base = 0
+    while True:
+        composite = sieve_window(initial_p + 2*base, sieve_window_size, strong)
+        for i in xrange(base + (w - base) % n, base + sieve_window_size, n):
+            # Checked even for sieved out candidates, since with n a multiple
+            # of a small prime, a worker may have nothing but those
+            if best is not None and i >= best.value:
+                return
+            if not composite[i - base]:
+                yield i
+        base += sieve_window_size
+
 # Returns number of bits in integer parameter
 def bits_in(n):
     # In some cases, python's log will introduce some inacuracy.
@@ -79,9 +158,10 @@ def quick_prime_test(p):
     return(None, "unknown")
 
 # Given a number of bits (default = 512) generate a prime of that bit-length and
-# return it.
-def generate_prime(bits=None, old=None):
+# return it. strong defaults to the --strong option.
+def generate_prime(bits=None, old=None, strong=None):
     if bits is None: bits = 512
+    if strong is None: strong = options.strong
     # Generate an initial random number
     initial_p = old or p_random(bits=bits)
     # Permute the number so that the high- and low-bits are set
@@ -89,39 +169,73 @@ def generate_prime(bits=None, old=None):
     high = 2**(bits-1)
     if initial_p < high: initial_p = initial_p + high
     if verbose > 1: print "Random starting point:", initial_p
-    # Now loop over p, p+2, p+4, ... testing for primality
-    for p in sequence_by_2(initial_p):
-        if verbose > 1:
-            strp = "%d"%p
-            try:
-                strp = re.compile(r'^(\d{5}).*(\d{5})$').sub(r'\1[...]\2',strp)
-            finally:
-                pass
-            print "Testing potential prime (%s)"%strp
-        elif verbose:
-            sys.stdout.write(".")
-        if is_prime(p,bits):
+    if pool is not None:
+        return parallel_search(initial_p, bits, strong)
+    # Now loop over p, p+2, p+4, ... testing the ones that survive the sieve
+    for i in sieved_indices(initial_p, strong=strong):
+        p = initial_p + 2*i
+        trace_candidate(p)
+        if is_prime(p,bits,sieved=True,strong=strong):
             return p
     raise "Can't get here?!"
 
+# Report (in verbose mode) that p is about to be tested
+def trace_candidate(p):
+    if verbose > 1:
+        strp = "%d"%p
+        try:
+            strp = re.compile(r'^(\d{5}).*(\d{5})$').sub(r'\1[...]\2',strp)
+        finally:
+            pass
+        print "Testing potential prime (%s)"%strp
+    elif verbose:
+        sys.stdout.write(".")
+
+# Set up a --threads worker (or the parent) with the shared lowest index.
+# Workers leave ^C to the parent, which shuts them down.
+def init_worker(best, worker=False):
+    global best_index
+    best_index = best
+    if worker:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+# Search p, p+2, p+4, ... on all of the --threads workers at once, and return
+# the first prime, just as the single-threaded loop in generate_prime would.
+def parallel_search(initial_p, bits, strong=None):
+    best_index.value = sys.maxint
+    nworkers = options.threads
+    work = [(initial_p, bits, strong, w, nworkers) for w in range(nworkers)]
+    # A timeout keeps the wait interruptible with ^C
+    pool.map_async(search_stride, work).get(999999999)
+    return initial_p + 2*best_index.value
+
+# Worker w (of n) tests candidate w, w+n, w+2n... (counting p, p+2, p+4...
+# from initial_p) until it gets past the lowest-indexed prime found by any
+# worker, itself included. Since every candidate below that one is tested by
+# some worker, the prime found is the same one that a single thread finds.
+def search_stride(work):
+    initial_p, bits, strong, w, n = work
+    for i in sieved_indices(initial_p, w, n, best_index, strong):
+        p = initial_p + 2*i
+        trace_candidate(p)
+        if is_prime(p, bits, sieved=True, strong=strong):
+            lock = best_index.get_lock()
+            lock.acquire()
+            try:
+                if i < best_index.value:
+                    best_index.value = i
+            finally:
+                lock.release()
+            return
+
 # Given a number of bits and an optional maximum value, generate a random number
 # of that many bits, optionally < the maximum.
 def p_random(bits=512, max=None):
     n = 0
-    bitsmask = reduce(lambda x,y: x|(1<<y), range(bits), 0)
+    if max:
+        bits = bits_in(max) + 1
     while n==0 or (max and n > max):
-        if max:
-            bits = bits_in(max)
-        # Read a number of bytes which will fit our required number of
-        # bits.
-        bytes = int(bits/8+1)
-        bitstring = os.urandom(bytes)
-        n = 0
-        for byte in range(bytes):
-            bs_byte = ord(bitstring[byte])
-            n = n | (bs_byte << (byte*8))
-        n = n & bitsmask
-    n = int(n) # just to be sure
+        n = random_bits(bits)
     return n
 
 # A simple generator for counting by 2
@@ -132,42 +246,79 @@ def sequence_by_2(start=0):
         n = n + 2
 
 # Test to see if p is prime. Return true/false
-def is_prime(p, bits, recursive=False):
+# If p survived sieve_window (with the same strong), the quick test would
+# learn nothing new, for p or for (p-1)/2.
+# strong defaults to the --strong option.
+def is_prime(p, bits, recursive=False, sieved=False, strong=None):
     global options, tab
     if not bits: bits = bits_in(p)
+    if strong is None: strong = options.strong
     # Our quick test returns a true/false only if it's sure,
     # otherwise we must test the long way.
-    isp, why = quick_prime_test(p)
+    if sieved and p > sieve_limit**2:
+        isp, why = None, "survived the sieve"
+    else:
+        isp, why = quick_prime_test(p)
+    if isp is None and strong and not recursive:
+        # Few candidates have both p and (p-1)/2 prime, so rule out the rest
+        # with one exponentiation each before any Rabin-Miller passes
+        isp, why = fermat_test(p)
+        if isp is None:
+            isp, why = fermat_test((p-1)>>1)
+            if isp is False:
+                why = "(p-1)/2 " + why
     if isp is not None:
         if verbose > 1:
             isnot = ""
             if not isp: isnot = "Not "
             print "", isnot, "prime:", why
     else:
-        isp, why = rm_prime_test(p)
+        if p < primality.DETERMINISTIC_LIMIT:
+            isp, why = deterministic_prime_test(p)
+        else:
+            isp, why = rm_prime_test(p)
         if verbose > 1:
             if isp:
                 print " RM: is prime:", why
             else:
                 print " RM: not prime:", why
-        if isp and not recursive and options.strong:
-            # If we require strong primes, test (p-1)/2 for primality too
-            if verbose > 1:
-                tab = "\t"
-                print " Testing prime for strength"
-            elif verbose:
-                sys.stdout.write("(")
-            isp = is_prime((p-1)>>1, bits, True)
-            if verbose:
-                tab = tab[:-1]
-                if verbose == 1:
-                    if isp:
-                        sys.stdout.write("~")
-                    else:
-                        sys.stdout.write("?")
-                    sys.stdout.write(")")
+    if isp and not recursive and strong:
+        # If we require strong primes, test (p-1)/2 for primality too
+        if verbose > 1:
+            tab = "\t"
+            print " Testing prime for strength"
+        elif verbose:
+            sys.stdout.write("(")
+        isp = is_prime((p-1)>>1, bits, True, sieved)
+        if verbose:
+            tab = tab[:-1]
+            if verbose == 1:
+                if isp:
+                    sys.stdout.write("~")
+                else:
+                    sys.stdout.write("?")
+                sys.stdout.write(")")
     return isp
 
+# Given a potential prime p below primality.DETERMINISTIC_LIMIT, return
+# True if it's prime and False if not, with certainty, in the same form as
+# rm_prime_test. Below that limit, a fixed set of Miller-Rabin witnesses is
+# known to catch every composite.
+def deterministic_prime_test(p):
+    if verbose==1: sys.stdout.write("D")
+    if primality.is_prime(p):
+        return(True, "deterministic Miller-Rabin witnesses prove primeality")
+    return(False, "deterministic Miller-Rabin witnesses failed")
+
+# Given an odd p > 2, return (False, reason) if it fails a base 2 Fermat test
+# and so can't be prime, or (None, reason) if it might be.
+def fermat_test(p):
+    if p < 3:
+        return(None, "too small for a Fermat test")
+    if mod_exp(2, p-1, p) != 1:
+        return(False, "base 2 Fermat test failed")
+    return(None, "base 2 Fermat test passed")
+
 # Given a potential prime p, return True if the Rabin-Miller test says it's
 # prime and False if not.
 # Return value is in the form of a list. Second value of the list is the
@@ -228,6 +379,19 @@ def rm_prime_test(p):
 
 # Given x, y, n return (x**y)mod n
 def mod_exp(x,y,n):
+    return backend_mod_exp(x,y,n)
+
+# Return a random number of up to the given number of bits, from the
+# system's /dev/urandom
+def random_bits(bits):
+    return backend_random_bits(bits)
+
+# The arithmetic backends (see -B) that mod_exp and random_bits use. "python"
+# is the original pure Python code, kept for comparison. "native" uses
+# Python's own three argument pow and reads random numbers in one piece. If
+# it's installed, "gmpy2" uses GMP for pow and is the default.
+
+def python_mod_exp(x,y,n):
     s = 1
     while y:
         if y & 1: s = (x*s) % n
@@ -235,6 +399,199 @@ def mod_exp(x,y,n):
         y>>=1
     return s
 
+def python_random_bits(bits):
+    bitsmask = reduce(lambda x,y: x|(1<<y), range(bits), 0)
+    # Read a number of bytes which will fit our required number of
+    # bits.
+    bytes = int(bits/8+1)
+    bitstring = os.urandom(bytes)
+    n = 0
+    for byte in range(bytes):
+        bs_byte = ord(bitstring[byte])
+        n = n | (bs_byte << (byte*8))
+    return n & bitsmask
+
+system_random = random.SystemRandom()
+
+backends = {
+    'python': (python_mod_exp, python_random_bits),
+    'native': (pow, system_random.getrandbits),
+}
+if gmpy2 is not None:
+    backends['gmpy2'] = (lambda x,y,n: long(gmpy2.powmod(x,y,n)), system_random.getrandbits)
+default_backend = 'gmpy2' if gmpy2 is not None else 'native'
+backend_mod_exp, backend_random_bits = backends[default_backend]
+
+# Time each backend at each number of bits (see --benchmark): a modular
+# exponentiation the size of one Rabin-Miller pass, and a random number.
+def benchmark(sizes=(512, 1024, 2048, 4096, 8192), repeat=3):
+    print "%6s %-8s %12s %12s %9s"%("bits", "backend", "mod_exp", "random", "speedup")
+    for bits in sizes:
+        n = system_random.getrandbits(bits) | (1<<(bits-1)) | 1
+        x = system_random.getrandbits(bits-1)
+        baseline = None
+        for name in sorted(backends, key=lambda name: name != 'python'):
+            exp, rand = backends[name]
+            exp_time = best_time(lambda: exp(x, n-1, n), repeat)
+            rand_time = best_time(lambda: rand(bits), repeat*100)
+            baseline = baseline or exp_time
+            print "%6d %-8s %11.6fs %11.6fs %8.1fx"%(
+                bits, name, exp_time, rand_time, baseline/exp_time)
+
+# Return the best time of repeat calls to f
+def best_time(f, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        f()
+        times.append(time.time() - start)
+    return min(times)
+
+# For --serve, a pool of ready primes for each (bits, strong) that has been
+# asked for, each kept topped up to --pool-size by refill_pools. Since only
+# that thread generates primes, --threads never has two searches at once.
+# There are at most --max-pools of them, and any but the one for --bits is
+# dropped once nobody has drawn from it for --pool-idle seconds.
+class PrimePool(object):
+    def __init__(self, bits, strong, permanent=False):
+        self.bits = bits
+        self.strong = strong
+        self.permanent = permanent
+        self.queue = Queue.Queue(options.pool_size)
+        self.used = time.time()
+        self.waiting = 0 # clients drawing from it right now
+
+    def idle(self, now):
+        return (not self.permanent and not self.waiting
+                and now - self.used > options.pool_idle)
+
+prime_pools = {}
+prime_pools_lock = threading.Lock()
+refill_wanted = threading.Event()
+
+# Return the pool of ready primes for (bits, strong), creating it if need be,
+# and count the caller as waiting on it until release_pool. Raises ValueError
+# if that would be more than --max-pools.
+def acquire_pool(bits, strong, permanent=False):
+    key = (bits, strong)
+    prime_pools_lock.acquire()
+    try:
+        drop_idle_pools()
+        if key not in prime_pools:
+            if len(prime_pools) >= options.max_pools:
+                raise ValueError("too many sizes in use, try again later")
+            prime_pools[key] = PrimePool(bits, strong, permanent)
+        prime_pool = prime_pools[key]
+        prime_pool.waiting += 1
+        prime_pool.used = time.time()
+    finally:
+        prime_pools_lock.release()
+    refill_wanted.set()
+    return prime_pool
+
+def release_pool(prime_pool):
+    prime_pools_lock.acquire()
+    try:
+        prime_pool.waiting -= 1
+        prime_pool.used = time.time()
+    finally:
+        prime_pools_lock.release()
+
+# Forget the pools nobody has used lately. Call with prime_pools_lock held.
+def drop_idle_pools():
+    now = time.time()
+    for key, prime_pool in prime_pools.items():
+        if prime_pool.idle(now):
+            del prime_pools[key]
+
+# Generate one prime at a time for whichever pool isn't full and needs it
+# most, starting with those that clients are waiting on, until they're all
+# full, and then wait to be told that one has been drawn from
+def refill_pools():
+    while True:
+        refill_wanted.wait()
+        refill_wanted.clear()
+        while True:
+            prime_pools_lock.acquire()
+            try:
+                drop_idle_pools()
+                hungry = [prime_pool for prime_pool in prime_pools.values()
+                          if not prime_pool.queue.full()]
+            finally:
+                prime_pools_lock.release()
+            if not hungry:
+                break
+            prime_pool = min(hungry, key=lambda prime_pool:
+                             (-prime_pool.waiting, prime_pool.queue.qsize()))
+            prime_pool.queue.put(generate_prime(prime_pool.bits, strong=prime_pool.strong))
+
+# Parse a --serve request, "bits [count [strong]]" separated by spaces or
+# commas, into (bits, count, strong). Raises ValueError if it's malformed.
+def parse_request(line):
+    fields = line.replace(",", " ").split()
+    if not 1 <= len(fields) <= 3:
+        raise ValueError("expected: bits [count [strong]]")
+    bits = int(fields[0])
+    count = 1
+    strong = options.strong
+    if len(fields) > 1:
+        count = int(fields[1])
+    if len(fields) > 2:
+        flag = fields[2].lower()
+        if flag in ("1", "y", "yes", "true", "strong"):
+            strong = True
+        elif flag in ("0", "n", "no", "false", "weak"):
+            strong = False
+        else:
+            raise ValueError("strong must be yes or no, not %r"%fields[2])
+    if bits < 2:
+        raise ValueError("minimum number of bits is 2")
+    if bits > options.max_bits:
+        raise ValueError("maximum number of bits is %d"%options.max_bits)
+    if count < 0:
+        raise ValueError("count can't be negative")
+    return bits, count, strong
+
+# Answer each request read from infile by writing that many primes to outfile,
+# one per line, as each comes off its queue. A bad request gets a single line
+# starting with "error:" instead.
+def serve_requests(infile, outfile):
+    for line in iter(infile.readline, ''):
+        if not line.strip():
+            continue
+        try:
+            bits, count, strong = parse_request(line)
+            prime_pool = acquire_pool(bits, strong)
+        except ValueError, e:
+            outfile.write("error: %s\n"%e)
+            outfile.flush()
+            continue
+        try:
+            for i in range(count):
+                # A timeout keeps the wait interruptible with ^C
+                p = prime_pool.queue.get(True, 999999999)
+                refill_wanted.set()
+                outfile.write("%d\n"%p)
+                outfile.flush()
+        finally:
+            release_pool(prime_pool)
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        serve_requests(self.rfile, self.wfile)
+
+# Serve requests from each client of the UNIX socket at path, at once
+def serve_socket(path):
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.unlink(path) # left over from an earlier run
+    server = SocketServer.ThreadingUnixStreamServer(path, RequestHandler)
+    server.daemon_threads = True
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+
 # I just want to say that while Python is a nifty language, and I like a great
 # deal of what it has to offer, its command-line processing features leave
 # much to be desired to someone coming from Perl.
@@ -248,8 +605,24 @@ parser.add_option("-c", "--count", dest="count", default=1, type="int")
 parser.add_option("-r", "--rabin-miller-iterations=", dest="rm_passes", default=5, type="int")
 parser.add_option("-s", "--strong", dest="strong", default=False, action="store_true")
 parser.add_option("-S", "--sequential", dest="sequential", default=False, action="store_true")
+parser.add_option("-t", "--threads", dest="threads", default=1, type="int")
+parser.add_option("-B", "--bigint-library", dest="backend", default=default_backend,
+                  type="choice", choices=sorted(backends.keys()))
+parser.add_option("--benchmark", dest="benchmark", default=False, action="store_true")
+parser.add_option("--serve", dest="serve", default=False, action="store_true")
+parser.add_option("--socket", dest="socket", default=None)
+parser.add_option("--pool-size", dest="pool_size", default=16, type="int")
+parser.add_option("--max-pools", dest="max_pools", default=8, type="int")
+parser.add_option("--pool-idle", dest="pool_idle", default=600, type="int")
+parser.add_option("--max-bits", dest="max_bits", default=8192, type="int")
 options, args = parser.parse_args()
 
+if options.benchmark:
+    benchmark()
+    exit()
+
+backend_mod_exp, backend_random_bits = backends[options.backend]
+
 verbose = options.verbose
 
 if options.bits < 2:
@@ -263,6 +636,41 @@ if verbose == 1:
 if options.strong and verbose:
     print "Note: You reduce the overall number of primes available by using -s"
 
+if options.threads > 1:
+    # Python threads can't do arithmetic in parallel, so these are processes
+    init_worker(multiprocessing.Value('l', sys.maxint))
+    pool = multiprocessing.Pool(options.threads, init_worker, (best_index, True))
+
+if options.serve or options.socket:
+    if options.pool_size < 1 or options.max_pools < 1:
+        print "Minimum pool size and number of pools is 1"
+        exit(1)
+    if options.bits > options.max_bits:
+        print "Maximum number of bits is %d (see --max-bits)"%options.max_bits
+        exit(1)
+    responses = sys.stdout
+    # Tracing goes to stderr, out of the way of the responses
+    sys.stdout = sys.stderr
+    refiller = threading.Thread(target=refill_pools)
+    refiller.daemon = True
+    refiller.start()
+    # Start on the primes that are most likely to be asked for, and keep them
+    release_pool(acquire_pool(options.bits, options.strong, permanent=True))
+    try:
+        if options.socket:
+            serve_socket(options.socket)
+        else:
+            serve_requests(sys.stdin, responses)
+    except KeyboardInterrupt:
+        pass
+    # The refill thread may be part way through a search, which would fail
+    # noisily as the interpreter shut down around it, so leave at once
+    responses.flush()
+    sys.stderr.flush()
+    if pool is not None:
+        pool.terminate()
+    os._exit(0)
+
 if not options.sequential and len(args) > 0:
     for p in args:
         if verbose: print "Prime given on command line:", p
@@ -334,7 +742,10 @@ mkprime - Generate large prime numbers randomly
        -R              Force use of non-pseudorandom number gen
        -s              Require cryptographically strong primes
        -S              Sequential numbers instead of random
-       -t <nthreads>   Number of threads to run in parallel
+       -t <nthreads>   Number of worker processes to run in parallel
+
+  mkprime --serve [--socket <path>] [--pool-size <n>] [--max-pools <n>]
+       [--pool-idle <seconds>] [--max-bits <bits>] [-b <bits>] [-s] [-t <nthreads>]
 
 =head1 DESCRIPTION
 
@@ -397,6 +808,12 @@ that will give a textual description of the progress.
 
 Given the name of a library such as FastCalc, force the use of that library.
 
+In the Python version, the choices are C<gmpy2> (GMP, the default if the
+C<gmpy2> module is installed), C<native> (Python's own long integers, the
+default otherwise) and C<python> (the original pure Python modular
+exponentiation, for comparison). Use C<--benchmark> to compare them at
+each size from 512 to 8192 bits.
+
 This primarily exists to override the workaround where C<--threads> disables
 the use of the GMP backend C<Math::BigInt::GMP>. The relevant bug is at:
 
@@ -461,6 +878,11 @@ low prime factors is also applied, further decreasing the chances
 of a false positive. For a 0.0015% chance, set C<--iterations> to
 8, and so on.
 
+In the Python version, numbers below about 3.3e24 are instead tested
+with a fixed set of Miller-Rabin witnesses which is known to catch every
+composite in that range (see F<primality.py>), so this option only
+matters above it.
+
 =item C<-s>
 
 =item C<--strong>
@@ -469,6 +891,10 @@ Turn on "strong" mode, where we test C<(p-1)/2> for primality too.
 If both I<C<p>> and I<C<(p-1)/2>> are prime, then the number is
 well suited for cryptographic applications.
 
+In the Python version, candidates are sieved for small factors of
+I<C<(p-1)/2>> as well as of I<C<p>>, and each survivor must pass a base 2
+Fermat test on both before any Rabin-Miller passes are spent on either.
+
 =item C<-S>
 
 =item C<--sequential>
@@ -495,9 +921,61 @@ There is no thread pooling, but fairly few threads need to be created when
 compared the amount of raw computation going on, so the thread creation
 overhead should be very small.
 
+In the Python version, these are a pool of worker processes (Python threads
+cannot do arithmetic in parallel). Each one tests every I<n>th candidate,
+and they stop once every candidate below the first prime found has been
+tested, so the result is always the same as with one thread.
+
 See B<THREADING ISSUES> for information on the combination of
 C<--threads> and this argument.
 
+=item C<--serve>
+
+Run as a service, for programs that need many primes and can't afford to
+start this program for each. Requests are read from standard input, one
+per line, in the form:
+
+ bits [count [strong]]
+
+where the fields are separated by spaces or commas, I<C<count>> defaults
+to 1 and I<C<strong>> is C<yes> or C<no> (defaulting to C<--strong>). The
+answer is I<C<count>> primes, one per line, or a single line starting with
+C<error:> if the request can't be parsed.
+
+A pool of ready primes is kept for each number of bits (and strength)
+that has been asked for, and topped up in the background as it is drawn
+from, so that a request only has to wait on a search when it asks for
+more than the pool holds. The pool for C<--bits> is filled from the
+start. Verbose output goes to standard error.
+
+=item C<--socket>
+
+Given a path, C<--serve> listens on a UNIX domain socket at that path
+instead of reading standard input. Each connection can send any number of
+requests, and is answered as above.
+
+=item C<--pool-size>
+
+Given a number, sets how many ready primes C<--serve> keeps for each
+number of bits. The default is 16.
+
+=item C<--max-pools>
+
+Given a number, sets how many numbers of bits (and strengths) C<--serve>
+keeps pools for at once. A request for another gets an C<error:> line
+until one of them is dropped. The default is 8.
+
+=item C<--pool-idle>
+
+Given a number of seconds, C<--serve> drops the pool for any number of
+bits that nobody has drawn from for that long, other than the pool for
+C<--bits>. The default is 600.
+
+=item C<--max-bits>
+
+Given a number, C<--serve> refuses requests for primes of more bits than
+that. The default is 8192.
+
 =back
 
 =head1 DIAGNOSTICS
@@ -511,6 +989,7 @@ Each character in the C<-v> output indicates some sort of status:
 
  . - A new prime is being tested
  R - The Rabin-Miller test is being applied
+ D - The deterministic test for numbers below 3.3e24 is being applied
  + - Rabin-Miller test is positive, but inconclusive
  _ - Rabin-Miller failed for this number (not prime)
  * or ! - Rabin-Miller passed (probably prime)
@@ -545,6 +1024,9 @@ made about the sequential nature of results when running in threaded mode.
 
 The results are otherwise just as correct, just not sequential.
 
+None of this applies to the Python version, which always finds the same
+primes, in the same order, however many workers C<--threads> asks for.
+
 =head1 AUTHOR
 
 Written in 2001 by Aaron Sherman.
@@ -0,0 +1,225 @@
+# Primality testing in tiers, shared by mkprime.py (Python 2) and
+# primepairseq.py (Python 3), so it has to run under both:
+#
+#  * below SMALL_LIMIT, a lookup in a table built by a sieve at import time
+#  * below DETERMINISTIC_LIMIT, Miller-Rabin with a fixed set of witnesses
+#    that is known to catch every composite in range (https://oeis.org/A014233)
+#  * above that, Baillie-PSW: a base 2 strong probable prime test followed by
+#    a strong Lucas probable prime test, which no known composite passes
+#
+# This program is distributed under the terms of the MIT License, which you can
+# find here: https://opensource.org/license/mit/ as well as in this repository's root
+# directory.
+
+SMALL_LIMIT = 1 << 16
+
+
+def _sieve(limit):
+    """Return a bytearray that is 1 at each prime index below limit"""
+
+    table = bytearray([1]) * limit
+    table[0:2] = bytearray(2)
+    for n in range(2, int(limit ** 0.5) + 1):
+        if table[n]:
+            table[n*n::n] = bytearray(len(range(n*n, limit, n)))
+    return table
+
+
+_SMALL_TABLE = _sieve(SMALL_LIMIT)
+SMALL_PRIMES = tuple(n for n in range(SMALL_LIMIT) if _SMALL_TABLE[n])
+
+# Trial division by these catches most composites above SMALL_LIMIT for
+# much less than the cost of one exponentiation
+TRIAL_PRIMES = SMALL_PRIMES[:50]
+
+# (limit, k): every composite below limit fails Miller-Rabin for at least one
+# of the first k primes as a witness
+WITNESS_LIMITS = (
+    (2047, 1),
+    (1373653, 2),
+    (25326001, 3),
+    (3215031751, 4),
+    (2152302898747, 5),
+    (3474749660383, 6),
+    (341550071728321, 7),
+    (3825123056546413051, 9),
+    (318665857834031151167461, 12),
+    (3317044064679887385961981, 13),
+)
+DETERMINISTIC_LIMIT = WITNESS_LIMITS[-1][0]
+
+
+def witnesses(n):
+    """The Miller-Rabin witnesses that decide n < DETERMINISTIC_LIMIT"""
+
+    for limit, k in WITNESS_LIMITS:
+        if n < limit:
+            return SMALL_PRIMES[:k]
+    raise ValueError("no deterministic witnesses for %d" % n)
+
+
+def strong_probable_prime(n, a):
+    """Does odd n > 2 pass the Miller-Rabin test for witness a?"""
+
+    d = n - 1
+    s = 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    x = pow(a, d, n)
+    if x == 1 or x == n - 1:
+        return True
+    for _ in range(s - 1):
+        x = x * x % n
+        if x == n - 1:
+            return True
+        if x == 1:
+            return False
+    return False
+
+
+def isqrt(n):
+    """The integer square root of n >= 0"""
+
+    if n < 2:
+        return n
+    x = 1 << ((n.bit_length() + 1) // 2)
+    while True:
+        y = (x + n // x) // 2
+        if y >= x:
+            return x
+        x = y
+
+
+def jacobi(a, n):
+    """The Jacobi symbol (a/n), for odd n > 0"""
+
+    a %= n
+    result = 1
+    while a:
+        while a % 2 == 0:
+            a //= 2
+            if n % 8 in (3, 5):
+                result = -result
+        a, n = n, a
+        if a % 4 == 3 and n % 4 == 3:
+            result = -result
+        a %= n
+    return result if n == 1 else 0
+
+
+def strong_lucas_probable_prime(n):
+    """
+    Does odd n > 2 pass the strong Lucas probable prime test, with
+    Selfridge's choice of parameters (D is the first of 5, -7, 9, -11, ...
+    with Jacobi symbol (D/n) = -1, P = 1 and Q = (1 - D)/4)?
+    """
+
+    if isqrt(n) ** 2 == n:
+        # There's no such D for a square, and no square is prime
+        return False
+    D = 5
+    while True:
+        j = jacobi(D, n)
+        if j == -1:
+            break
+        if j == 0 and abs(D) != n:
+            return False
+        D = -D - 2 if D > 0 else -D + 2
+    P = 1
+    Q = (1 - D) // 4
+
+    def half(x):
+        x %= n
+        return (x + n) // 2 if x % 2 else x // 2
+
+    # n + 1 = d * 2**s with d odd
+    d = n + 1
+    s = 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    # U, V and Q**k for k = 1, then doubled (and incremented) along d's bits
+    U, V, Qk = 1, P, Q % n
+    for bit in bin(d)[3:]:
+        U, V = U * V % n, (V * V - 2 * Qk) % n
+        Qk = Qk * Qk % n
+        if bit == '1':
+            U, V = half(P * U + V), half(D * U + P * V)
+            Qk = Qk * Q % n
+    if U == 0 or V == 0:
+        return True
+    for _ in range(s - 1):
+        V = (V * V - 2 * Qk) % n
+        if V == 0:
+            return True
+        Qk = Qk * Qk % n
+    return False
+
+
+def is_prime(n):
+    """
+    Is the integer n prime?
+
+    This is certain below DETERMINISTIC_LIMIT, and above it relies on
+    Baillie-PSW, for which no counterexample is known.
+    """
+
+    if n < SMALL_LIMIT:
+        return n >= 0 and _SMALL_TABLE[n] == 1
+    for p in TRIAL_PRIMES:
+        if n % p == 0:
+            return False
+    if n < DETERMINISTIC_LIMIT:
+        return all(strong_probable_prime(n, a) for a in witnesses(n))
+    return strong_probable_prime(n, 2) and strong_lucas_probable_prime(n)
+
+
+def test_small_table():
+    """Test the table against trial division"""
+
+    def trial(n):
+        return n > 1 and all(n % d for d in range(2, isqrt(n) + 1))
+    assert [n for n in range(-5, 2000) if is_prime(n)] == [n for n in range(2000) if trial(n)]
+    assert len(SMALL_PRIMES) == 6542
+
+
+def test_witness_limits():
+    """Each limit is the first composite that its own witnesses can't catch"""
+
+    for limit, k in WITNESS_LIMITS:
+        assert all(strong_probable_prime(limit, a) for a in SMALL_PRIMES[:k])
+        assert not is_prime(limit)
+
+
+def test_is_prime():
+    """Test primes and composites from each tier"""
+
+    # https://oeis.org/A014233 are strong pseudoprimes to the first k prime
+    # bases, and Carmichael numbers fool a plain Fermat test
+    composites = (
+        65537 * 65539, 1373653, 25326001, 3215031751, 2152302898747,
+        3474749660383, 341550071728321, 3825123056546413051,
+        318665857834031151167461, 3317044064679887385961981,
+        561, 41041, 825265, 321197185, 5394826801, 232250619601,
+        (2**89 - 1) * (2**61 - 1), (2**127 - 1) ** 2,
+    )
+    primes = (
+        65537, 2147483647, 2305843009213693951, 618970019642690137449562111,
+        2**89 - 1, 2**107 - 1, 2**127 - 1, 2**521 - 1,
+    )
+    for n in composites:
+        assert not is_prime(n), n
+    for n in primes:
+        assert is_prime(n), n
+
+
+def test_strong_lucas():
+    """Strong Lucas pseudoprimes (https://oeis.org/A217255) pass the Lucas test alone"""
+
+    for n in (5459, 5777, 10877, 16109, 18971, 22499, 24569, 25199, 40309, 58519):
+        assert strong_lucas_probable_prime(n), n
+        assert not strong_probable_prime(n, 2), n
+        assert not is_prime(n), n
+    for n in SMALL_PRIMES[1:200]:
+        assert strong_lucas_probable_prime(n), n
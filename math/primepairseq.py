@@ -1,77 +1,27 @@
 #!/usr/bin/env python3
 
 import math
-import random
 import pytest
 import argparse
+import functools
 import itertools
 
+import primality
 
-LOW_PRIMES = (
-    2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59,
-    61, 67, 71, 73, 79, 83, 89, 97, 101, 103, 107, 109, 113, 127,
-)
 
-
-def miller_rabin(p):
-    """
-    Miller-Rabin statistical prime check algorithm.
-
-    Note that this implementation assumes the input is an
-    odd integer > 2.
-    """
-
-    m = p - 1
-    k = 0
-    while m % 2 == 0:
-        m //= 2
-        k += 1
-    a = random.randint(2, p-1)
-    x = pow(a, m, p)
-    if x in (1, p-1):
-        return True
-    while k > 1:
-        x = pow(x, 2, p)
-        if x == 1:
-            return False
-        if x == p-1:
-            return True
-        k -= 1
-    return False
-
-
-def is_prime(p, repeat=20):
+def is_prime(p):
     """
     Is p a prime integer?
 
-    This is a combination of a fast check followed by a slower,
-    statistical check. The fast check will only return True or False
-    if the primality of the value can be determined with certainty.
-    Otherwise, it will defer to the statistical check.
-
-    Repeat defaults to 20, denoting iterations of the Miller-Rabin check,
-    which is extreme overkill for anything we'll need.
+    This defers to primality.is_prime, which answers the small sums that
+    we check by table lookup, and anything below 3.3e24 with certainty.
 
     All finite, real numeric inputs are handled.
     """
 
-    # High level quick check:
     if p < 2 or p != int(p):
         return False
-    max_static = LOW_PRIMES[-1]
-    sqrt_p = (max_static + 1 if p > max_static else sqrt(p))
-    for n in LOW_PRIMES:
-        if p == n:
-            return True
-        if p % n == 0:
-            return False
-        if n >= sqrt_p:
-            return True
-    # Statistical check:
-    for i in range(repeat):
-        if not miller_rabin(p):
-            return False
-    return True
+    return primality.is_prime(int(p))
 
 
 def seq_lens(start_len, until_fail=False):
@@ -112,20 +62,110 @@ def asymetric_permutations(input_seq):
             yield rest[0:pos] + first + rest[pos:]
 
 
+def bits_of(bitset):
+    """The index of each set bit in bitset, lowest first"""
+
+    while bitset:
+        low = bitset & -bitset
+        yield low.bit_length() - 1
+        bitset ^= low
+
+
+def count_bits(bitset):
+    return bin(bitset).count("1")
+
+
+@functools.lru_cache(maxsize=None)
+def prime_sum_graph(values):
+    """
+    Which pairs of values sum to a prime, as a tuple of bitsets: bit j of
+    the ith is set if values[i] + values[j] is prime.
+    """
+
+    graph = [0] * len(values)
+    for i, j in itertools.combinations(range(len(values)), 2):
+        if is_prime(values[i] + values[j]):
+            graph[i] |= 1 << j
+            graph[j] |= 1 << i
+    return tuple(graph)
+
+
+def prime_sum_paths(values, length=None):
+    """
+    Generate each sequence of length (default all) of the distinct values
+    in which every adjacent pair sums to a prime, by backtracking along
+    prime_sum_graph. Each one is generated forwards and backwards.
+
+    The value with the fewest onward choices is always tried first
+    (Warnsdorff's rule), and when looking for a path through all of the
+    values, a branch is dropped as soon as some value can no longer be
+    reached from either end of it.
+    """
+
+    values = tuple(values)
+    graph = prime_sum_graph(values)
+    if length is None:
+        length = len(values)
+    hamiltonian = length == len(values)
+
+    def stranded(end, unvisited):
+        """Can some unvisited value no longer be part of the path?"""
+
+        reachable = unvisited | (1 << end)
+        last = 0
+        for v in bits_of(unvisited):
+            degree = count_bits(graph[v] & reachable)
+            if degree == 0:
+                return True
+            if degree == 1 and not graph[v] >> end & 1:
+                # v can only be the last value, and only one value can be
+                last += 1
+                if last > 1:
+                    return True
+        return False
+
+    def choices(end, unvisited):
+        """The values that could follow end, in the order to try them"""
+
+        if hamiltonian and stranded(end, unvisited):
+            return iter(())
+        return iter(sorted(bits_of(graph[end] & unvisited), key=lambda v: count_bits(graph[v] & unvisited)))
+
+    # The choices left at each step are kept on a stack, rather than recursing,
+    # so that the length isn't limited by Python's recursion limit
+    everything = (1 << len(values)) - 1
+    for start in sorted(range(len(values)), key=lambda v: count_bits(graph[v])):
+        path = [start]
+        unvisited = everything & ~(1 << start)
+        if length == 1:
+            yield (values[start],)
+            continue
+        stack = [choices(start, unvisited)]
+        while stack:
+            v = next(stack[-1], None)
+            if v is None:
+                stack.pop()
+                unvisited |= 1 << path.pop()
+                continue
+            path.append(v)
+            unvisited &= ~(1 << v)
+            if len(path) == length:
+                yield tuple(values[i] for i in path)
+                path.pop()
+                unvisited |= 1 << v
+            else:
+                stack.append(choices(v, unvisited))
+
+
 def solve(nseq, seq_len=None, remove_symetry=False):
     """Check for solutions in the given sequence"""
 
-    if seq_len is None:
-        seq_len = len(nseq)
-    if remove_symetry:
-        perms = asymetric_permutations(nseq)
-    else:
-        perms = itertools.permutations(nseq, seq_len)
-        
-    for nseq_check in perms:
-        if is_solved(nseq_check):
-            record_solution(nseq_check)
-            yield nseq_check
+    for solution in prime_sum_paths(nseq, seq_len):
+        # Every path is found from both ends, so keep just one of them
+        if remove_symetry and len(solution) > 1 and solution[0] > solution[-1]:
+            continue
+        record_solution(solution)
+        yield solution
 
 
 def speculative_solution(solution, next_value):
@@ -239,6 +279,44 @@ def test_is_prime(n, prime):
     assert is_prime(n) is prime, f"Expect is_prime({n}) -> {prime!r}"
 
 
+@pytest.mark.parametrize('length', [2, 3, 6, 8])
+def test_solve(length):
+    """Test that the solver finds just the solutions that brute force does"""
+
+    nseq = range(1, length + 1)
+    expected = set(p for p in itertools.permutations(nseq) if is_solved(p))
+    found = list(solve(nseq))
+    assert len(found) == len(set(found))
+    assert set(found) == expected
+
+    # With symmetry removed, the brute force answer comes from
+    # asymetric_permutations, which keeps an arbitrary one of each mirrored
+    # pair, so compare pairs rather than sequences
+    def mirrored(solutions):
+        return set(min(tuple(s), tuple(reversed(s))) for s in solutions)
+    asymetric = [p for p in asymetric_permutations(nseq) if is_solved(p)]
+    unique = list(solve(nseq, remove_symetry=True))
+    assert len(unique) == len(asymetric)
+    assert mirrored(unique) == mirrored(asymetric)
+
+
+def test_solve_partial():
+    """Test sequences shorter than the range"""
+
+    nseq = range(1, 7)
+    expected = set(p for p in itertools.permutations(nseq, 4) if is_solved(p))
+    assert set(solve(nseq, 4)) == expected
+
+
+@pytest.mark.parametrize('length', [30, 60])
+def test_solve_long(length):
+    """Long sequences take moments, not forever"""
+
+    solution = next(solve(range(1, length + 1)))
+    assert sorted(solution) == list(range(1, length + 1))
+    assert is_solved(solution)
+
+
 @pytest.mark.parametrize('inseq, outseq', [
     ([1,2,3], ([1, 2, 3], [1, 3, 2], [2, 1, 3])),
     ([1,2], ([1,2],)),